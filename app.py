@@ -1,18 +1,30 @@
-from flask import Flask, request, render_template, jsonify, url_for, send_file, redirect, flash, session
+from flask import Blueprint, Flask, Response, request, render_template, jsonify, url_for, send_file, redirect, flash, session, stream_with_context
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
-from openai import OpenAI
-from elevenlabs import ElevenLabs, VoiceSettings
 from dotenv import load_dotenv
-import sqlite3
+
+# Load .env before the modules below read their settings from the environment
+load_dotenv()
+
 import os
 import time
 import logging
 import uuid
-from pydub import AudioSegment
-import re
-from datetime import datetime
-import stripe
+import hashlib
+import base64
+import json
+import math
+from functools import wraps
+from clients import get_stripe
+from db import init_db, query_one, query_all, transaction
+from ledger import reserve_credit, refund_reservation, grant_credits, apply_stripe_purchase, SIGNUP
+from tasks import enqueue_meditation_job, get_job_status
+from metrics import span, observe, render_metrics, METRICS_TOKEN
+from streaming import iter_stream, stream_available
+from ratelimit import check_route_limit
+from audio import ENCODING_PROFILES
+from storage import storage_for
+from maintenance import enqueue_rerender, record_play
 
 # Configure logging
 logging.basicConfig(
@@ -22,298 +34,121 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-load_dotenv()
-if not os.path.exists("static/audio"):
-    os.makedirs("static/audio")
+# Audio delivery: a render never changes once written, so browsers may cache it for a year. A re-render
+# (after eviction) or re-encode gets a new render id, and with it a new ETag.
+# AUDIO_OFFLOAD hands the byte transfer to the front proxy: "x-accel" (nginx) or "x-sendfile" (Apache, lighttpd)
+AUDIO_CACHE_MAX_AGE = 31536000
+AUDIO_OFFLOAD = os.getenv("AUDIO_OFFLOAD", "").lower()
+AUDIO_ACCEL_PREFIX = os.getenv("AUDIO_ACCEL_PREFIX", "/protected-audio/")
 
-app = Flask(__name__, static_folder='static', static_url_path='/static')
-app.secret_key = os.urandom(24)
-app.config['REMEMBER_COOKIE_DURATION'] = 604800  # 7 days
+stripe_publishable_key = os.getenv("STRIPE_PUBLISHABLE_KEY")
+stripe_webhook_secret = os.getenv("STRIPE_WEBHOOK_SECRET")
+CREDITS_PER_PURCHASE = 10
+
+LIBRARY_PAGE_SIZE = 10
+LIBRARY_MAX_PAGE_SIZE = 50
 
-# Initialize Flask-Login
 login_manager = LoginManager()
-login_manager.init_app(app)
-login_manager.login_view = 'login'
-
-# Initialize OpenAI client
-openai_client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-if not os.getenv("OPENAI_API_KEY"):
-    logger.error("OPENAI_API_KEY not set in .env")
-    raise ValueError("Please set OPENAI_API_KEY in .env file")
-
-# Initialize ElevenLabs client
-elevenlabs_client = ElevenLabs(api_key=os.getenv("ELEVENLABS_API_KEY"))
-if not os.getenv("ELEVENLABS_API_KEY"):
-    logger.error("ELEVENLABS_API_KEY not set in .env")
-    raise ValueError("Please set ELEVENLABS_API_KEY in .env file")
-
-# Initialize Stripe
-stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
-stripe_publishable_key = os.getenv("STRIPE_PUBLISHABLE_KEY")
-if not os.getenv("STRIPE_SECRET_KEY"):
-    logger.error("STRIPE_SECRET_KEY not set in .env")
-    raise ValueError("Please set STRIPE_SECRET_KEY in .env file")
-if not os.getenv("STRIPE_PUBLISHABLE_KEY"):
-    logger.error("STRIPE_PUBLISHABLE_KEY not set in .env")
-    raise ValueError("Please set STRIPE_PUBLISHABLE_KEY in .env file")
-
-# SQLite setup
-def init_db():
-    conn = sqlite3.connect('users.db')
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS users
-                 (id TEXT PRIMARY KEY, email TEXT UNIQUE, password TEXT, credits INTEGER)''')
-    c.execute('''CREATE TABLE IF NOT EXISTS files
-                 (id TEXT PRIMARY KEY, user_id TEXT, job_id TEXT, file_path TEXT, situation TEXT, created_at TIMESTAMP,
-                  FOREIGN KEY(user_id) REFERENCES users(id))''')
-    conn.commit()
-    conn.close()
-
-init_db()
+login_manager.login_view = 'main.login'
+
+bp = Blueprint("main", __name__)
+
+def create_app(init_database=True):
+    """Build the web app. Nothing heavy happens at import; API clients are created on first use."""
+    app = Flask(__name__, static_folder='static', static_url_path='/static')
+    secret_key = os.getenv("SECRET_KEY")
+    if not secret_key:
+        # Sessions will not survive a restart or be shared between workers
+        logger.warning("SECRET_KEY not set in .env, using a random per-process key")
+        secret_key = os.urandom(24)
+    app.secret_key = secret_key
+    app.config['REMEMBER_COOKIE_DURATION'] = 604800  # 7 days
+    login_manager.init_app(app)
+    app.register_blueprint(bp)
+    if init_database:
+        init_db()
+    return app
 
 # User model
 class User(UserMixin):
-    def __init__(self, id, email, credits):
+    def __init__(self, id, email, credits, plan="free"):
         self.id = id
         self.email = email
         self.credits = credits
+        self.plan = plan or "free"
 
 @login_manager.user_loader
 def load_user(user_id):
-    conn = sqlite3.connect('users.db')
-    c = conn.cursor()
-    c.execute('SELECT id, email, credits FROM users WHERE id = ?', (user_id,))
-    user_data = c.fetchone()
-    conn.close()
+    user_data = query_one("SELECT id, email, credits, plan FROM users WHERE id = :id", {"id": user_id})
     if user_data:
-        return User(user_data[0], user_data[1], user_data[2])
+        return User(user_data[0], user_data[1], user_data[2], user_data[3])
     return None
 
-def clean_text(text):
-    """Remove special characters that may cause issues."""
-    replacements = {
-        '…': '...',
-        '’': "'",
-        '“': '"',
-        '”': '"',
-        '—': '-',
-        '**': '',
-    }
-    for old, new in replacements.items():
-        text = text.replace(old, new)
-    text = re.sub(r'[^\w\s.,!?\'"-]', '', text)
-    return text
-
-def generate_meditation_script(situation):
-    logger.info(f"Generating meditation script for situation: {situation}")
-    start_time = time.time()
-
-    try:
-        prompt = (
-            f"Create a calming meditation script addressing '{situation}'. "
-            "The script should be approximately 5 minutes long (600-750 words) when read at a soothing pace. "
-            "Include 3-4 explicit pauses marked as '[PAUSE 20 SECONDS]' for silent reflection. "
-            "Keep it soothing, structured with clear breathing instructions, and use a warm, empathetic tone to ease the user's anxiety. "
-            "Avoid special characters like curly quotes, em dashes, or asterisks."
-        )
-        response = openai_client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": "You are a meditation guide crafting personalized, calming scripts."},
-                {"role": "user", "content": prompt}
-            ],
-            max_tokens=1000,
-            temperature=0.7
-        )
-        script = response.choices[0].message.content.strip()
-        script = clean_text(script)
-        logger.info(f"GPT-4o script generated in {time.time() - start_time:.2f} seconds")
-        return script
-    except Exception as e:
-        logger.error(f"Script generation failed: {str(e)}")
-        script = f"""
-        Welcome to your meditation. Find a comfortable position and close your eyes. 
-        Take a deep breath in, and exhale slowly, letting tension slip away. [PAUSE 20 SECONDS]
-        Imagine a serene lake, its surface calm and still. As you breathe in, feel your worries about {situation} soften. 
-        Exhale, releasing them into the water. Let your shoulders relax, your mind ease. 
-        Picture yourself sitting by this lake, the air cool and gentle. Each breath brings calm deeper into your body. [PAUSE 20 SECONDS]
-        Now, visualize a quiet forest path. Each step grounds you, each breath calms you. 
-        Notice the soft sunlight filtering through the trees, warming your face. Feel your anxiety easing, replaced by peace. 
-        You are safe here, held by the earth beneath you. Let your breath flow naturally, slow and steady. [PAUSE 20 SECONDS]
-        Picture a gentle stream, its flow carrying away any remaining stress. 
-        Inhale deeply, filling your lungs with calm. Exhale, letting go completely. 
-        Feel your body light, your mind clear. You are present, at ease, whole. [PAUSE 20 SECONDS]
-        As we close, carry this tranquility with you, knowing you can return here anytime. 
-        Take one final deep breath, and when you are ready, gently open your eyes.
-        """
-        script = clean_text(script)
-        logger.info("Using fallback static script")
-        return script
-
-def generate_audio(script, job_id, user_id, situation):
-    logger.info(f"Starting audio generation for job {job_id}, user {user_id}")
-    start_time = time.time()
-
-    try:
-        # Split script by pauses, ensuring no empty segments
-        segments = [s.strip() for s in script.split("[PAUSE 20 SECONDS]") if s.strip()]
-        if not segments:
-            raise Exception("No valid segments found in script")
-        logger.info(f"Found {len(segments)} script segments")
-
-        audio_path = f"static/audio/audio_{user_id}_{job_id}.mp3"
-        temp_silence = f"static/audio/silence_{job_id}.mp3"
-
-        # Generate 20-second silence
-        silence = AudioSegment.silent(duration=20000)  # 20 seconds in milliseconds
-        silence.export(temp_silence, format="mp3")
-
-        # Generate audio for each segment
-        temp_files = []
-        for i, segment in enumerate(segments):
-            segment_path = f"static/audio/segment_{job_id}_{i}.mp3"
-            try:
-                logger.info(f"Generating audio for segment {i}: {segment[:50]}...")
-                cleaned_segment = segment.replace("[PAUSE 20 SECONDS]", "").strip()
-                if not cleaned_segment:
-                    logger.warning(f"Segment {i} is empty after cleaning, skipping")
-                    continue
-                audio_stream = elevenlabs_client.generate(
-                    text=cleaned_segment,
-                    voice="Rachel",
-                    model="eleven_monolingual_v1",
-                    voice_settings=VoiceSettings(
-                        stability=0.5,
-                        similarity_boost=0.5
-                    )
-                )
-                # Save audio stream to file
-                with open(segment_path, "wb") as f:
-                    for chunk in audio_stream:
-                        if chunk:
-                            f.write(chunk)
-                # Verify the generated file
-                audio_segment = AudioSegment.from_mp3(segment_path)
-                if audio_segment.duration_seconds > 0:
-                    temp_files.append(segment_path)
-                    logger.info(f"Segment {i} duration: {audio_segment.duration_seconds:.2f} seconds")
-                else:
-                    logger.warning(f"Skipping empty segment {i} for job {job_id}")
-            except Exception as e:
-                logger.error(f"Failed to generate segment {i} for job {job_id}: {str(e)}")
-                continue
-            # Add silence after each segment (except the last)
-            if i < len(segments) - 1:
-                temp_files.append(temp_silence)
-                logger.info(f"Added 20-second silence after segment {i}")
-
-        if not temp_files:
-            raise Exception("No valid audio segments or silence generated")
-
-        # Concatenate audio files
-        combined = AudioSegment.empty()
-        total_duration = 0
-        for file in temp_files:
-            try:
-                segment = AudioSegment.from_mp3(file)
-                combined += segment
-                total_duration += segment.duration_seconds
-                logger.info(f"Added {file} to combined audio, duration now: {total_duration:.2f} seconds")
-            except Exception as e:
-                logger.error(f"Failed to process file {file}: {str(e)}")
-                continue
-        if total_duration < 60:  # Ensure at least 1 minute
-            raise Exception(f"Generated audio too short: {total_duration:.2f} seconds")
-        combined.export(audio_path, format="mp3")
-        logger.info(f"Final audio exported to {audio_path}")
-
-        # Clean up temporary files (keep final audio)
-        for file in temp_files:
-            if os.path.exists(file):
-                try:
-                    os.remove(file)
-                except Exception as e:
-                    logger.error(f"Failed to delete temp file {file}: {str(e)}")
-
-        # Save file metadata to database
-        conn = sqlite3.connect('users.db')
-        c = conn.cursor()
-        file_id = str(uuid.uuid4())
-        created_at = datetime.utcnow()
-        c.execute(
-            "INSERT INTO files (id, user_id, job_id, file_path, situation, created_at) VALUES (?, ?, ?, ?, ?, ?)",
-            (file_id, user_id, job_id, audio_path, situation, created_at)
-        )
-        conn.commit()
-        conn.close()
-
-        total_time = time.time() - start_time
-        logger.info(f"Audio generation completed for job {job_id} in {total_time:.2f} seconds, total duration: {total_duration:.2f} seconds")
-        return audio_path
-    except Exception as e:
-        logger.error(f"Audio generation failed for job {job_id}: {str(e)}")
-        # Clean up any remaining temp files
-        for file in [f"static/audio/segment_{job_id}_{i}.mp3" for i in range(len(segments))] + [temp_silence]:
-            if os.path.exists(file):
-                try:
-                    os.remove(file)
-                except Exception as e:
-                    logger.error(f"Failed to delete temp file {file}: {str(e)}")
-        raise
-
-@app.route("/signup", methods=["GET", "POST"])
+def rate_limited(route, methods=None):
+    """Throttle a view per user with the limit for `route` and their plan.
+
+    Runs before the view touches the database; `methods` restricts it to some HTTP methods.
+    Logged-out requests are not counted: they can only save the form and get sent to the login page.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if (methods is None or request.method in methods) and current_user.is_authenticated:
+                wait = check_route_limit(route, current_user.plan, current_user.id)
+                if wait > 0:
+                    logger.info(f"Rate limited user {current_user.id} on {route}, retry in {wait:.1f} seconds")
+                    response = jsonify({"error": "Too many requests, please try again shortly"})
+                    response.headers["Retry-After"] = str(math.ceil(wait))
+                    return response, 429
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
+@bp.route("/signup", methods=["GET", "POST"])
 def signup():
     if current_user.is_authenticated:
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
     if request.method == "POST":
         email = request.form.get("email")
         password = request.form.get("password")
         logger.info(f"Signup attempt for email: {email}")
         try:
-            conn = sqlite3.connect('users.db')
-            c = conn.cursor()
-            c.execute("SELECT email FROM users WHERE email = ?", (email,))
-            if c.fetchone():
+            if query_one("SELECT email FROM users WHERE email = :email", {"email": email}):
                 flash("Email already exists.")
-                conn.close()
                 return render_template("signup.html")
             user_id = str(uuid.uuid4())
             hashed_password = generate_password_hash(password)
-            c.execute("INSERT INTO users (id, email, password, credits) VALUES (?, ?, ?, ?)",
-                     (user_id, email, hashed_password, 2))
-            conn.commit()
-            conn.close()
+            with transaction() as tx:
+                tx.execute("INSERT INTO users (id, email, password, credits) VALUES (:id, :email, :password, 0)",
+                           {"id": user_id, "email": email, "password": hashed_password})
+                grant_credits(user_id, 2, SIGNUP, user_id, tx=tx)
             user = User(user_id, email, 2)
             login_user(user, remember=True)
             logger.info(f"User {email} signed up with 2 credits")
             flash("Signup successful! You have 2 credits.")
-            return redirect(url_for('index'))
+            return redirect(url_for('main.index'))
         except Exception as e:
             logger.error(f"Signup failed: {str(e)}")
             flash("An error occurred during signup.")
             return render_template("signup.html")
     return render_template("signup.html")
 
-@app.route("/login", methods=["GET", "POST"])
+@bp.route("/login", methods=["GET", "POST"])
 def login():
     if current_user.is_authenticated:
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
     if request.method == "POST":
         email = request.form.get("email")
         password = request.form.get("password")
         logger.info(f"Login attempt for email: {email}")
         try:
-            conn = sqlite3.connect('users.db')
-            c = conn.cursor()
-            c.execute("SELECT id, email, password, credits FROM users WHERE email = ?", (email,))
-            user_data = c.fetchone()
-            conn.close()
+            user_data = query_one("SELECT id, email, password, credits, plan FROM users WHERE email = :email", {"email": email})
             if user_data and check_password_hash(user_data[2], password):
-                user = User(user_data[0], user_data[1], user_data[3])
+                user = User(user_data[0], user_data[1], user_data[3], user_data[4])
                 login_user(user, remember=True)
                 logger.info(f"User {email} logged in")
                 flash("Login successful!")
-                return redirect(url_for('index'))
+                return redirect(url_for('main.index'))
             flash("Invalid email or password.")
             return render_template("login.html")
         except Exception as e:
@@ -322,132 +157,342 @@ def login():
             return render_template("login.html")
     return render_template("login.html")
 
-@app.route("/logout")
+@bp.route("/logout")
 @login_required
 def logout():
     logger.info(f"User {current_user.email} logging out")
     logout_user()
     flash("Logged out successfully.")
-    return redirect(url_for('index'))
+    return redirect(url_for('main.index'))
 
-@app.route("/", methods=["GET", "POST"])
+@bp.route("/", methods=["GET", "POST"])
+@rate_limited("generate", methods=("POST",))
 def index():
     logger.info("Received request to /")
-    saved_files = []
-    if current_user.is_authenticated:
-        conn = sqlite3.connect('users.db')
-        c = conn.cursor()
-        c.execute("SELECT job_id, file_path, situation, created_at FROM files WHERE user_id = ? ORDER BY created_at DESC",
-                 (current_user.id,))
-        saved_files = [
-            {
-                "job_id": row[0],
-                "audio_url": url_for('get_audio', job_id=row[0], _external=True),
-                "situation": row[2],
-                "created_at": row[3]
-            } for row in c.fetchall()
-        ]
-        conn.close()
-
     if request.method == "POST":
         if not current_user.is_authenticated:
             session['situation'] = request.form.get("situation")
             logger.info("User not logged in, redirecting to login")
-            return jsonify({"redirect": url_for('login')})
+            return jsonify({"redirect": url_for('main.login')})
         
         if current_user.credits < 1:
             logger.info(f"User {current_user.email} has no credits, redirecting to payments")
-            return jsonify({"redirect": url_for('payments')})
+            return jsonify({"redirect": url_for('main.payments')})
 
         situation = request.form.get("situation")
         logger.info(f"Processing POST request with situation: {situation}")
         start_time = time.time()
 
         try:
-            # Deduct credit first
-            conn = sqlite3.connect('users.db')
-            c = conn.cursor()
-            c.execute("UPDATE users SET credits = credits - 1 WHERE id = ?", (current_user.id,))
-            conn.commit()
-            c.execute("SELECT credits FROM users WHERE id = ?", (current_user.id,))
-            current_user.credits = c.fetchone()[0]
-            conn.close()
-
-            script = generate_meditation_script(situation)
             job_id = str(uuid.uuid4())
             logger.info(f"Generated job ID: {job_id}")
-            logger.info("Generating audio synchronously")
-            audio_path = generate_audio(script, job_id, current_user.id, situation)
-            audio_url = url_for('get_audio', job_id=job_id, _external=True)
-            
-            logger.info(f"Audio generated at {audio_path} in {time.time() - start_time:.2f} seconds")
+            # Reserve the credit first; it is committed or refunded when the job finishes
+            remaining = reserve_credit(current_user.id, job_id)
+            if remaining is None:
+                logger.info(f"User {current_user.email} ran out of credits, redirecting to payments")
+                return jsonify({"redirect": url_for('main.payments')})
+            current_user.credits = remaining
+            try:
+                enqueue_meditation_job(job_id, current_user.id, situation)
+            except Exception:
+                # Nothing was queued, so give the credit back
+                refund_reservation(job_id)
+                raise
+
+            logger.info(f"Job {job_id} enqueued in {time.time() - start_time:.2f} seconds")
+            observe("submit", time.time() - start_time)
             logger.info(f"User {current_user.email} credits updated to {current_user.credits}")
-            return jsonify({"job_id": job_id, "script": script, "audio_url": audio_url, "credits": current_user.credits})
+            return jsonify({
+                "job_id": job_id,
+                "status_url": url_for('main.job_status', job_id=job_id),
+                "credits": current_user.credits
+            }), 202
         except Exception as e:
             logger.error(f"POST request failed: {str(e)}")
             return jsonify({"error": str(e)}), 500
 
+    saved_files, next_cursor = [], None
+    if current_user.is_authenticated:
+        # Only the newest page is rendered; the rest of the library loads on demand from /library
+        saved_files, next_cursor = fetch_library_page(current_user.id, None, LIBRARY_PAGE_SIZE)
+
     situation = session.pop('situation', None)
     logger.info("Rendering index.html for GET request")
-    return render_template("index.html", situation=situation, credits=getattr(current_user, 'credits', 0), saved_files=saved_files)
+    return render_template("index.html", situation=situation, credits=getattr(current_user, 'credits', 0),
+                           saved_files=saved_files, next_cursor=next_cursor)
+
+def encode_library_cursor(created_at, file_id):
+    return base64.urlsafe_b64encode(json.dumps([str(created_at), file_id]).encode("utf-8")).decode("ascii")
+
+def decode_library_cursor(cursor):
+    created_at, file_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    return created_at, file_id
+
+def fetch_library_page(user_id, cursor, limit):
+    """Return (files, next_cursor) for one page of a user's library, newest first.
+
+    Keyset pagination on (created_at, id): every page is a bounded range scan of
+    idx_files_user_created no matter how deep into the library it is.
+    """
+    params = {"user_id": user_id, "limit": limit + 1}
+    if cursor:
+        params["created_at"], params["id"] = decode_library_cursor(cursor)
+        rows = query_all(
+            "SELECT id, job_id, situation, created_at, evicted_at IS NOT NULL FROM files WHERE user_id = :user_id "
+            "AND (created_at < :created_at OR (created_at = :created_at AND id < :id)) "
+            "ORDER BY created_at DESC, id DESC LIMIT :limit", params
+        )
+    else:
+        rows = query_all(
+            "SELECT id, job_id, situation, created_at, evicted_at IS NOT NULL FROM files WHERE user_id = :user_id "
+            "ORDER BY created_at DESC, id DESC LIMIT :limit", params
+        )
+    next_cursor = encode_library_cursor(rows[limit - 1][3], rows[limit - 1][0]) if len(rows) > limit else None
+    profiles = rendition_profiles([row[1] for row in rows[:limit]])
+    files = [
+        {
+            "job_id": row[1],
+            "audio_url": url_for('main.get_audio', job_id=row[1]),
+            "sources": audio_sources(row[1], profiles.get(row[1], ())),
+            "script_url": url_for('main.get_script', job_id=row[1]),
+            "situation": row[2],
+            "created_at": str(row[3]),
+            "evicted": bool(row[4])
+        } for row in rows[:limit]
+    ]
+    return files, next_cursor
+
+@bp.route("/library")
+@login_required
+def library():
+    try:
+        limit = min(max(int(request.args.get("limit", LIBRARY_PAGE_SIZE)), 1), LIBRARY_MAX_PAGE_SIZE)
+        files, next_cursor = fetch_library_page(current_user.id, request.args.get("cursor"), limit)
+    except (ValueError, TypeError) as e:
+        return jsonify({"error": f"Invalid pagination parameters: {str(e)}"}), 400
+    except Exception as e:
+        logger.error(f"Failed to fetch library for user {current_user.id}: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+    return jsonify({"files": files, "next_cursor": next_cursor})
+
+@bp.route("/jobs/<job_id>")
+@login_required
+def job_status(job_id):
+    try:
+        status = get_job_status(job_id)
+    except Exception as e:
+        logger.error(f"Failed to fetch status for job {job_id}: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+    if not status or status["user_id"] != current_user.id:
+        return jsonify({"error": "Job not found"}), 404
+    response = {"job_id": job_id, "stage": status["stage"]}
+    if status["script"]:
+        response["script"] = status["script"]
+    if status["stage"] in ("synthesizing", "mixing", "done") and stream_available(job_id):
+        response["stream_url"] = url_for('main.stream_audio', job_id=job_id)
+    if status["stage"] == "done":
+        response["audio_url"] = url_for('main.get_audio', job_id=job_id, _external=True)
+        response["sources"] = audio_sources(job_id, rendition_profiles([job_id]).get(job_id, ()))
+    elif status["stage"] == "failed":
+        response["error"] = status["error"]
+    return jsonify(response)
+
+@bp.route("/stream/<job_id>")
+@login_required
+@rate_limited("audio")
+def stream_audio(job_id):
+    """Play a meditation while it is still being synthesized."""
+    try:
+        status = get_job_status(job_id)
+    except Exception as e:
+        logger.error(f"Failed to fetch status for job {job_id}: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+    if not status or status["user_id"] != current_user.id:
+        return "Audio not found", 404
+    if status["stage"] in ("done", "failed") and not stream_available(job_id):
+        return "Live stream no longer available", 404
+    logger.info(f"Starting live stream for job {job_id}")
+    response = Response(stream_with_context(iter_stream(job_id)), mimetype="audio/mpeg")
+    response.headers["Cache-Control"] = "no-store"
+    response.headers["X-Accel-Buffering"] = "no"  # let a fronting nginx pass chunks straight through
+    return response
+
+def audio_etag(job_id, profile=None, render_id=None):
+    # The same job's audio can be written again, so the render id is part of the strong validator;
+    # rows written before render ids existed were never rewritten
+    etag = f"audio-{job_id}-{profile}" if profile else f"audio-{job_id}"
+    return f"{etag}-{render_id}" if render_id else etag
+
+def set_audio_cache_headers(response, etag, negotiated=False):
+    response.set_etag(etag)
+    response.cache_control.no_cache = False
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.cache_control.max_age = AUDIO_CACHE_MAX_AGE
+    response.cache_control.immutable = True
+    response.headers["Accept-Ranges"] = "bytes"
+    if negotiated:
+        response.vary.update(("Accept", "Save-Data"))
+    return response
+
+def choose_rendition(available):
+    """The rendition profile to send for this request, or None for the full-quality MP3.
+
+    `?profile=` wins when that rendition exists. Otherwise a smaller rendition is
+    sent only if the client prefers its type over MP3 in `Accept`, or asks to save
+    data (`Save-Data: on`) and accepts the type at all.
+    """
+    requested = request.args.get("profile")
+    if requested:
+        return requested if requested in available else None
+    accept = request.accept_mimetypes
+    save_data = request.headers.get("Save-Data", "").lower() == "on"
+    for profile in ENCODING_PROFILES:
+        if profile not in available:
+            continue
+        mimetype = ENCODING_PROFILES[profile]["mimetype"]
+        if save_data and (not accept or accept[mimetype]):
+            return profile
+        if accept[mimetype] > accept["audio/mpeg"]:
+            return profile
+    return None
 
-@app.route("/audio/<job_id>")
+def audio_sources(job_id, profiles):
+    """<source> entries for a meditation, best quality first.
+
+    Browsers play the first source they can, so it must be the plain URL: every
+    browser plays MP3, and choose_rendition picks the encoding from the request's
+    headers. The renditions follow only as fallbacks if the full MP3 fails to load.
+    """
+    sources = [{"url": url_for('main.get_audio', job_id=job_id), "type": "audio/mpeg"}]
+    sources.extend({"url": url_for('main.get_audio', job_id=job_id, profile=profile),
+                    "type": ENCODING_PROFILES[profile]["source_type"]}
+                   for profile in reversed(ENCODING_PROFILES) if profile in profiles)
+    return sources
+
+def rendition_profiles(job_ids):
+    """job_id -> set of rendition profiles stored for it."""
+    if not job_ids:
+        return {}
+    params = {f"j{i}": job_id for i, job_id in enumerate(job_ids)}
+    placeholders = ", ".join(f":j{i}" for i in range(len(job_ids)))
+    profiles = {}
+    for job_id, profile in query_all(f"SELECT job_id, profile FROM renditions WHERE job_id IN ({placeholders})", params):
+        profiles.setdefault(job_id, set()).add(profile)
+    return profiles
+
+@bp.route("/audio/<job_id>")
 @login_required
+@rate_limited("audio")
 def get_audio(job_id):
     logger.info(f"Fetching audio for job {job_id}")
+    with span("file_serve"):
+        return _serve_audio(job_id)
+
+def _serve_audio(job_id):
     try:
-        conn = sqlite3.connect('users.db')
-        c = conn.cursor()
-        c.execute("SELECT file_path FROM files WHERE job_id = ? AND user_id = ?", (job_id, current_user.id))
-        result = c.fetchone()
-        conn.close()
-        if not result:
+        rows = query_all(
+            "SELECT f.file_path, r.profile, r.file_path, f.evicted_at, f.script IS NOT NULL, f.render_id, r.render_id "
+            "FROM files f LEFT JOIN renditions r ON r.job_id = f.job_id "
+            "WHERE f.job_id = :job_id AND f.user_id = :user_id",
+            {"job_id": job_id, "user_id": current_user.id}
+        )
+        if not rows:
             logger.warning(f"Audio not found for job {job_id}")
             return "Audio not found", 404
-        audio_path = result[0]
+        if rows[0][3]:
+            if not rows[0][4]:
+                return "Audio file missing", 404
+            # Evicted by maintenance to save space; render it again from the stored script
+            enqueue_rerender(job_id, current_user.id)
+            response = jsonify({"status": "restoring", "status_url": url_for('main.job_status', job_id=job_id)})
+            response.headers["Retry-After"] = "30"
+            return response, 202
+        record_play(job_id)
+        available = {row[1]: (row[2], row[6]) for row in rows if row[1] in ENCODING_PROFILES}
+        profile = choose_rendition(available)
+        negotiated = "profile" not in request.args
+        etag = audio_etag(job_id, profile, available[profile][1] if profile else rows[0][5])
+        if request.if_none_match.contains(etag):
+            return set_audio_cache_headers(Response(status=304), etag, negotiated)
+        if profile:
+            audio_path = available[profile][0]
+            mimetype = ENCODING_PROFILES[profile]["mimetype"]
+            download_name = f"meditation_{job_id}.{ENCODING_PROFILES[profile]['extension']}"
+        else:
+            audio_path, mimetype, download_name = rows[0][0], "audio/mpeg", f"meditation_{job_id}.mp3"
+        storage = storage_for(audio_path)
+        url = storage.presigned_url(audio_path, filename=download_name)
+        if url:
+            # The browser fetches the bytes (and Range requests) from object storage directly.
+            # The URL expires, so the redirect itself must not be cached
+            logger.info(f"Redirecting audio for job {job_id} to object storage")
+            response = redirect(url, code=302)
+            response.headers["Cache-Control"] = "private, no-store"
+            return response
         if not os.path.exists(audio_path):
             logger.warning(f"Audio file missing for job {job_id} at {audio_path}")
             return "Audio file missing", 404
-        logger.info(f"Sending audio for job {job_id}")
-        return send_file(
-            audio_path,
-            mimetype="audio/mp3",
+
+        if AUDIO_OFFLOAD == "x-accel":
+            # nginx serves the bytes (including Range requests) from an internal location
+            logger.info(f"Offloading audio for job {job_id} via X-Accel-Redirect")
+            response = Response(mimetype=mimetype)
+            response.headers["X-Accel-Redirect"] = AUDIO_ACCEL_PREFIX + os.path.basename(audio_path)
+            return set_audio_cache_headers(response, etag, negotiated)
+        if AUDIO_OFFLOAD == "x-sendfile":
+            logger.info(f"Offloading audio for job {job_id} via X-Sendfile")
+            response = Response(mimetype=mimetype)
+            response.headers["X-Sendfile"] = os.path.abspath(audio_path)
+            return set_audio_cache_headers(response, etag, negotiated)
+
+        logger.info(f"Sending {profile or 'full-quality'} audio for job {job_id}")
+        response = send_file(
+            os.path.abspath(audio_path),  # send_file resolves relative paths against the app root, not the cwd
+            mimetype=mimetype,
             as_attachment=False,
-            download_name=f"meditation_{job_id}.mp3"
+            download_name=download_name,
+            conditional=True,  # answers Range requests with 206 Partial Content
+            etag=etag
         )
+        return set_audio_cache_headers(response, etag, negotiated)
     except Exception as e:
         logger.error(f"Failed to fetch audio for job {job_id}: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
-@app.route("/get_script/<job_id>")
+@bp.route("/get_script/<job_id>")
 @login_required
+@rate_limited("script")
 def get_script(job_id):
     try:
-        conn = sqlite3.connect('users.db')
-        c = conn.cursor()
-        c.execute("SELECT situation FROM files WHERE job_id = ? AND user_id = ?", (job_id, current_user.id))
-        situation = c.fetchone()
-        if not situation:
+        result = query_one("SELECT script FROM files WHERE job_id = :job_id AND user_id = :user_id",
+                           {"job_id": job_id, "user_id": current_user.id})
+        if not result:
             return jsonify({"error": "File not found"}), 404
-        # Regenerate script deterministically
-        script = generate_meditation_script(situation[0])
-        conn.close()
-        return jsonify({"script": script})
+        if not result[0]:
+            # Meditations generated before scripts were stored have nothing to show
+            return jsonify({"error": "Script not available for this meditation"}), 404
+        # The stored script is exactly what was narrated and never changes
+        response = jsonify({"script": result[0]})
+        response.set_etag(hashlib.sha256(result[0].encode("utf-8")).hexdigest())
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        return response.make_conditional(request)
     except Exception as e:
         logger.error(f"Failed to fetch script for job {job_id}: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
-@app.route("/payments")
+@bp.route("/payments")
 @login_required
 def payments():
     logger.info(f"User {current_user.email} accessing payments page")
     return render_template("payments.html", stripe_publishable_key=stripe_publishable_key)
 
-@app.route("/create-checkout-session", methods=["POST"])
+@bp.route("/create-checkout-session", methods=["POST"])
 @login_required
 def create_checkout_session():
     try:
-        checkout_session = stripe.checkout.Session.create(
+        checkout_session = get_stripe().checkout.Session.create(
             payment_method_types=['card'],
             line_items=[
                 {
@@ -457,47 +502,40 @@ def create_checkout_session():
             ],
             metadata={'user_id': current_user.id},
             mode='payment',
-            success_url=url_for('success', _external=True),
-            cancel_url=url_for('cancel', _external=True),
+            success_url=url_for('main.success', _external=True),
+            cancel_url=url_for('main.cancel', _external=True),
         )
         logger.info(f"Checkout session created for user {current_user.email}: {checkout_session.id}")
-        # Update credits immediately (no webhook)
-        conn = sqlite3.connect('users.db')
-        c = conn.cursor()
-        c.execute("UPDATE users SET credits = credits + 10 WHERE id = ?", (current_user.id,))
-        conn.commit()
-        conn.close()
-        logger.info(f"Added 10 credits to user {current_user.id}")
         return jsonify({'id': checkout_session.id})
     except Exception as e:
         logger.error(f"Failed to create checkout session for user {current_user.email}: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
-@app.route("/success")
+@bp.route("/success")
 @login_required
 def success():
-    flash("Payment successful! 10 credits added to your account.")
-    return redirect(url_for('index'))
+    flash("Payment successful! Your 10 credits are added as soon as Stripe confirms the payment.")
+    return redirect(url_for('main.index'))
 
-@app.route("/cancel")
+@bp.route("/cancel")
 @login_required
 def cancel():
     flash("Payment cancelled. No credits were added.")
-    return redirect(url_for('index'))
+    return redirect(url_for('main.index'))
 
-@app.route("/webhook", methods=["POST"])
+@bp.route("/webhook", methods=["POST"])
 def stripe_webhook():
     payload = request.get_data(as_text=True)
     sig_header = request.headers.get('Stripe-Signature')
 
     try:
-        event = stripe.Webhook.construct_event(
+        event = get_stripe().Webhook.construct_event(
             payload, sig_header, stripe_webhook_secret
         )
     except ValueError as e:
         logger.error(f"Invalid webhook payload: {str(e)}")
         return jsonify({'error': 'Invalid payload'}), 400
-    except stripe.error.SignatureVerificationError as e:
+    except get_stripe().error.SignatureVerificationError as e:
         logger.error(f"Invalid webhook signature: {str(e)}")
         return jsonify({'error': 'Invalid signature'}), 400
 
@@ -506,19 +544,25 @@ def stripe_webhook():
         user_id = session.get('metadata', {}).get('user_id')
         if user_id:
             try:
-                conn = sqlite3.connect('users.db')
-                c = conn.cursor()
-                c.execute("UPDATE users SET credits = credits + 10 WHERE id = ?", (user_id,))
-                conn.commit()
-                conn.close()
-                logger.info(f"Added 10 credits to user {user_id} via webhook")
+                if not apply_stripe_purchase(event['id'], event['type'], user_id, CREDITS_PER_PURCHASE, session['id']):
+                    logger.info(f"Webhook event {event['id']} already applied, ignoring")
             except Exception as e:
                 logger.error(f"Failed to update credits for user {user_id}: {str(e)}")
                 return jsonify({'error': str(e)}), 500
 
     return jsonify({'status': 'success'}), 200
 
+@bp.route("/metrics")
+def metrics():
+    if METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+        return "Unauthorized", 401
+    try:
+        return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
+    except Exception as e:
+        logger.error(f"Failed to render metrics: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
 if __name__ == "__main__":
     logger.info("Starting Flask application")
     port = int(os.environ.get("PORT", 5000))
-    app.run(host="0.0.0.0", port=port, debug=False)
\ No newline at end of file
+    create_app().run(host="0.0.0.0", port=port, debug=False)
\ No newline at end of file
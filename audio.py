@@ -0,0 +1,388 @@
+from metrics import span
+import io
+import logging
+import os
+import subprocess
+import threading
+
+logger = logging.getLogger(__name__)
+
+# "frames" splices MP3 frames without re-encoding, "pcm" decodes once and encodes once,
+# "auto" uses frames whenever every segment shares one MP3 stream format
+AUDIO_CONCAT_MODE = os.getenv("AUDIO_CONCAT_MODE", "auto")
+# pydub is only imported for PCM work, so the web process (which streams frames) never loads it
+
+# Optional MP3 assets, loaded once per process. Ambience is mixed under the whole meditation,
+# which needs PCM assembly; chimes are spliced as frames when they share the narration's format
+AUDIO_INTRO_CHIME = os.getenv("AUDIO_INTRO_CHIME", "")
+AUDIO_OUTRO_CHIME = os.getenv("AUDIO_OUTRO_CHIME", "")
+AUDIO_AMBIENCE = os.getenv("AUDIO_AMBIENCE", "")
+AUDIO_AMBIENCE_GAIN_DB = float(os.getenv("AUDIO_AMBIENCE_GAIN_DB", -18))
+# (frame rate, channels, sample width) of narration once decoded: ElevenLabs' default mp3_44100_128 output.
+# Assets are decoded to it ahead of time, so the PCM path can use them without running ffmpeg
+NARRATION_PCM_FORMAT = (44100, 1, 2)
+
+# Smaller encodings made once per meditation next to the full-quality MP3, for listeners on slow or metered
+# connections. Narration is one voice, so mono at a speech bitrate loses little. Opus VBR spends very little
+# on the long silences, which is most of a meditation; the MP3 stays constant bitrate because a VBR header
+# cannot be written to a stream, and without one players misjudge the duration and seek badly.
+ENCODING_PROFILES = {
+    "speech-opus": {
+        "mimetype": "audio/ogg",
+        "source_type": 'audio/ogg; codecs="opus"',
+        "extension": "opus",
+        "args": ["-ac", "1", "-c:a", "libopus", "-b:a", "24k", "-vbr", "on", "-application", "voip", "-f", "ogg"],
+    },
+    "speech-mp3": {
+        "mimetype": "audio/mpeg",
+        "source_type": "audio/mpeg",
+        "extension": "mp3",
+        "args": ["-ac", "1", "-ar", "22050", "-c:a", "libmp3lame", "-b:a", "48k", "-f", "mp3"],
+    },
+}
+# Profiles the worker renders ("" = only the full-quality MP3); negotiation tries them smallest first, in the order above
+AUDIO_RENDITIONS = [name.strip() for name in os.getenv("AUDIO_RENDITIONS", "speech-opus,speech-mp3").split(",")
+                    if name.strip() in ENCODING_PROFILES]
+
+# MPEG audio version bits -> version, Layer III bitrates (kbps) and sample rates (Hz)
+_MPEG_VERSIONS = {0: 2.5, 2: 2, 3: 1}
+_BITRATES = {
+    1: [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    2: [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+_SAMPLE_RATES = {
+    1: [44100, 48000, 32000],
+    2: [22050, 24000, 16000],
+    2.5: [11025, 12000, 8000],
+}
+
+def parse_frame_header(data, pos):
+    """Parse the MPEG-1/2/2.5 Layer III frame header at `pos`, or return None."""
+    if pos + 4 > len(data) or data[pos] != 0xFF or (data[pos + 1] & 0xE0) != 0xE0:
+        return None
+    version = _MPEG_VERSIONS.get((data[pos + 1] >> 3) & 0x03)
+    layer_bits = (data[pos + 1] >> 1) & 0x03
+    bitrate_index = data[pos + 2] >> 4
+    sample_rate_index = (data[pos + 2] >> 2) & 0x03
+    if version is None or layer_bits != 1 or bitrate_index in (0, 15) or sample_rate_index == 3:
+        return None
+    bitrate = _BITRATES[1 if version == 1 else 2][bitrate_index] * 1000
+    sample_rate = _SAMPLE_RATES[version][sample_rate_index]
+    padding = (data[pos + 2] >> 1) & 0x01
+    samples = 1152 if version == 1 else 576
+    return {
+        "version": version,
+        "sample_rate": sample_rate,
+        "channel_mode": data[pos + 3] >> 6,
+        "samples": samples,
+        "length": samples // 8 * bitrate // sample_rate + padding,
+    }
+
+def _is_info_frame(frame, header):
+    """True for the Xing/Info metadata frame encoders put in front of the audio."""
+    mono = header["channel_mode"] == 3
+    if header["version"] == 1:
+        offset = 4 + (17 if mono else 32)
+    else:
+        offset = 4 + (9 if mono else 17)
+    if not frame[1] & 0x01:  # CRC present
+        offset += 2
+    return frame[offset:offset + 4] in (b"Xing", b"Info")
+
+def split_mp3_frames(data):
+    """Split an MP3 byte string into its audio frames.
+
+    ID3 tags and the Xing/Info header frame are dropped; returns (format, frames)
+    where format is (version, sample_rate, channel_mode), or (None, []) if the
+    data does not look like a clean Layer III stream.
+    """
+    pos = 0
+    if data[:3] == b"ID3" and len(data) >= 10:
+        pos = 10 + ((data[6] << 21) | (data[7] << 14) | (data[8] << 7) | data[9])
+    frames = []
+    stream_format = None
+    while pos < len(data):
+        if data[pos:pos + 3] == b"TAG":  # ID3v1 trailer
+            break
+        header = parse_frame_header(data, pos)
+        if header is None or pos + header["length"] > len(data):
+            return None, []
+        frame_format = (header["version"], header["sample_rate"], header["channel_mode"])
+        if stream_format is None:
+            stream_format = frame_format
+        elif frame_format != stream_format:
+            return None, []
+        frame = data[pos:pos + header["length"]]
+        if not _is_info_frame(frame, header):
+            frames.append(frame)
+        pos += header["length"]
+    return stream_format, frames
+
+def silent_mp3_frames(template_frame, duration_ms):
+    """Build digital-silence MP3 frames matching `template_frame`, without an encoder.
+
+    A Layer III frame whose side info and main data are all zero decodes to
+    silence, so we reuse the template's header (CRC off, no padding) and zero
+    everything after it. Returns (frames, sample_count).
+    """
+    header = bytearray(template_frame[:4])
+    header[1] |= 0x01  # protection bit set = no CRC
+    header[2] &= 0xFD  # clear padding bit
+    info = parse_frame_header(header, 0)
+    frame = bytes(header) + bytes(info["length"] - 4)
+    count = round(duration_ms / 1000 * info["sample_rate"] / info["samples"])
+    return frame * count, count * info["samples"]
+
+class AudioAssets:
+    """Process-wide registry of silence, chimes and ambience, each rendered once and reused.
+
+    Silence is cached per stream format and duration, both as MP3 frames and as
+    PCM bytes. Chime and ambience files are read once and decoded copies are
+    kept per PCM format. Once preload() has run, a job whose narration is in
+    NARRATION_PCM_FORMAT never touches the disk or ffmpeg for an asset; one in
+    another format decodes its own copy on first use.
+    """
+
+    def __init__(self, intro=AUDIO_INTRO_CHIME, outro=AUDIO_OUTRO_CHIME, ambience=AUDIO_AMBIENCE,
+                 ambience_gain_db=AUDIO_AMBIENCE_GAIN_DB):
+        self.paths = {name: path for name, path in (("intro", intro), ("outro", outro), ("ambience", ambience)) if path}
+        self.ambience_gain_db = ambience_gain_db
+        self._clips = {}
+        self._clip_frames = {}
+        self._decoded = {}
+        self._silence_frames = {}
+        self._silence_pcm = {}
+        self._lock = threading.Lock()
+
+    def has(self, name):
+        return self.clip(name) is not None
+
+    def clip(self, name):
+        """Raw MP3 bytes of a configured asset, or None if it is unset or unreadable."""
+        if name not in self.paths:
+            return None
+        with self._lock:
+            if name not in self._clips:
+                try:
+                    with open(self.paths[name], "rb") as f:
+                        self._clips[name] = f.read()
+                    logger.info(f"Loaded {name} asset from {self.paths[name]}")
+                except OSError as e:
+                    logger.error(f"Failed to load {name} asset: {str(e)}")
+                    self._clips[name] = None
+            return self._clips[name]
+
+    def clip_frames(self, name):
+        """(format, frame_bytes, frame_count) for a configured asset, or None."""
+        data = self.clip(name)
+        if data is None:
+            return None
+        with self._lock:
+            if name not in self._clip_frames:
+                frame_format, frames = split_mp3_frames(data)
+                self._clip_frames[name] = (frame_format, b"".join(frames), len(frames)) if frames else None
+            return self._clip_frames[name]
+
+    def decoded(self, name, frame_rate, channels, sample_width):
+        """A configured asset as an AudioSegment in the given PCM format, or None."""
+        data = self.clip(name)
+        if data is None:
+            return None
+        key = (name, frame_rate, channels, sample_width)
+        with self._lock:
+            if key not in self._decoded:
+                from pydub import AudioSegment
+                segment = AudioSegment.from_file(io.BytesIO(data), format="mp3")
+                segment = segment.set_frame_rate(frame_rate).set_channels(channels).set_sample_width(sample_width)
+                if name == "ambience":
+                    segment = segment.apply_gain(self.ambience_gain_db)
+                self._decoded[key] = segment
+            return self._decoded[key]
+
+    def silence_frames(self, template_frame, duration_ms):
+        """Cached silent_mp3_frames() for the template's stream format."""
+        key = (template_frame[:4], duration_ms)
+        with self._lock:
+            if key not in self._silence_frames:
+                self._silence_frames[key] = silent_mp3_frames(template_frame, duration_ms)
+            return self._silence_frames[key]
+
+    def silence_pcm(self, frame_rate, frame_width, duration_ms):
+        key = (frame_rate, frame_width, duration_ms)
+        with self._lock:
+            if key not in self._silence_pcm:
+                # Signed PCM silence is all zero bytes; no need to build and decode an AudioSegment
+                self._silence_pcm[key] = bytes(int(frame_rate * duration_ms / 1000) * frame_width)
+            return self._silence_pcm[key]
+
+    def preload(self):
+        """Read, split and decode every configured asset now, e.g. in a worker before it forks jobs."""
+        for name in self.paths:
+            self.clip_frames(name)
+            try:
+                self.decoded(name, *NARRATION_PCM_FORMAT)
+            except Exception as e:
+                logger.error(f"Failed to decode {name} asset: {str(e)}")
+
+_assets = None
+_assets_lock = threading.Lock()
+
+def get_assets():
+    global _assets
+    with _assets_lock:
+        if _assets is None:
+            _assets = AudioAssets()
+        return _assets
+
+def _gaps(pauses, count):
+    """Per-gap pause lengths in ms: `pauses` is either one length for every gap or a list."""
+    if isinstance(pauses, (int, float)):
+        return [pauses] * (count - 1)
+    gaps = list(pauses)[:count - 1]
+    return gaps + [0] * (count - 1 - len(gaps))
+
+def _concat_frames(segment_audio, gaps, assets):
+    split = [split_mp3_frames(audio) for audio in segment_audio]
+    stream_format = split[0][0]
+    if any(not frames or frame_format != stream_format for frame_format, frames in split):
+        return None
+    intro, outro = assets.clip_frames("intro"), assets.clip_frames("outro")
+    for name, clip in (("intro", intro), ("outro", outro)):
+        if assets.has(name) and (clip is None or clip[0] != stream_format):
+            return None
+    template = split[0][1][0]
+    samples_per_frame = parse_frame_header(template, 0)["samples"]
+    parts = []
+    total_samples = 0
+    if intro is not None:
+        parts.append(intro[1])
+        total_samples += intro[2] * samples_per_frame
+    for i, (_, frames) in enumerate(split):
+        if i > 0 and gaps[i - 1] > 0:
+            silence, silence_samples = assets.silence_frames(template, gaps[i - 1])
+            parts.append(silence)
+            total_samples += silence_samples
+        parts.append(b"".join(frames))
+        total_samples += len(frames) * samples_per_frame
+    if outro is not None:
+        parts.append(outro[1])
+        total_samples += outro[2] * samples_per_frame
+    return parts, total_samples / stream_format[1]
+
+# Raw PCM formats ffmpeg reads from a pipe, by sample width
+_PCM_CODECS = {1: "u8", 2: "s16le", 4: "s32le"}
+_ENCODE_CHUNK = 64 * 1024
+
+def _pipe_through_ffmpeg(args, data, out):
+    """Run ffmpeg reading `data` on stdin, writing its stdout to `out` as it is produced."""
+    from pydub import AudioSegment
+    process = subprocess.Popen(
+        [AudioSegment.converter, "-hide_banner", "-loglevel", "error"] + args,
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+
+    def feed():
+        try:
+            process.stdin.write(data)
+        except BrokenPipeError:
+            pass  # ffmpeg exited early; its exit code says why
+        finally:
+            process.stdin.close()
+
+    feeder = threading.Thread(target=feed, daemon=True)
+    feeder.start()
+    try:
+        for chunk in iter(lambda: process.stdout.read(_ENCODE_CHUNK), b""):
+            out.write(chunk)
+    except BaseException:
+        process.kill()
+        raise
+    finally:
+        feeder.join()
+        process.stdout.close()
+        stderr = process.stderr.read()
+        process.stderr.close()
+        process.wait()
+    if process.returncode != 0:
+        raise Exception(f"ffmpeg failed: {stderr.decode(errors='replace').strip()}")
+
+def _encode_mp3(segment, out):
+    """Encode `segment` to MP3, writing to `out` as ffmpeg produces it instead of buffering the file."""
+    if segment.sample_width not in _PCM_CODECS:
+        # 24-bit audio has no raw format here; storage writers cannot seek, so pydub's export is no fallback
+        segment = segment.set_sample_width(2)
+    codec = _PCM_CODECS[segment.sample_width]
+    _pipe_through_ffmpeg(
+        ["-f", codec, "-ar", str(segment.frame_rate), "-ac", str(segment.channels), "-i", "pipe:0",
+         "-f", "mp3", "pipe:1"],
+        segment.raw_data, out
+    )
+
+def _concat_pcm(segment_audio, gaps, assets, out):
+    from pydub import AudioSegment
+    with span("decode"):
+        decoded = [AudioSegment.from_file(io.BytesIO(audio), format="mp3") for audio in segment_audio]
+    first = decoded[0]
+    pcm_format = (first.frame_rate, first.channels, first.sample_width)
+    with span("concat"):
+        intro, outro = assets.decoded("intro", *pcm_format), assets.decoded("outro", *pcm_format)
+        parts = []
+        if intro is not None:
+            parts.append(intro.raw_data)
+        for i, segment in enumerate(decoded):
+            if i > 0 and gaps[i - 1] > 0:
+                parts.append(assets.silence_pcm(first.frame_rate, first.frame_width, gaps[i - 1]))
+            if (segment.frame_rate, segment.channels, segment.sample_width) != pcm_format:
+                segment = segment.set_frame_rate(first.frame_rate).set_channels(first.channels).set_sample_width(first.sample_width)
+            parts.append(segment.raw_data)
+        if outro is not None:
+            parts.append(outro.raw_data)
+        combined = first._spawn(b"".join(parts))
+        ambience = assets.decoded("ambience", *pcm_format)
+        if ambience is not None:
+            # The pre-decoded bed is tiled under the mix; one pass of sample addition, no extra decode
+            combined = combined.overlay(ambience, loop=True)
+    with span("export"):
+        _encode_mp3(combined, out)
+    return combined.duration_seconds
+
+def assemble_meditation(segment_audio, pauses, mode=None, out=None):
+    """Join narrated MP3 segments with silence between them, plus any configured chimes and ambience.
+
+    `pauses` is the silence in ms after each segment but the last, or a single
+    length for every gap. Returns (mp3_bytes, duration_seconds). Each segment
+    is handled once, in memory. With `out` (a writable file or storage writer)
+    the MP3 is written there as it is produced and (None, duration_seconds) is
+    returned.
+    """
+    mode = mode or AUDIO_CONCAT_MODE
+    if not segment_audio:
+        raise Exception("No audio segments to assemble")
+    assets = get_assets()
+    gaps = _gaps(pauses, len(segment_audio))
+    if assets.has("ambience"):
+        if mode == "frames":
+            raise Exception("Ambience mixing needs PCM assembly; unset AUDIO_AMBIENCE or use AUDIO_CONCAT_MODE=auto")
+        mode = "pcm"
+    if mode in ("auto", "frames"):
+        with span("concat"):
+            result = _concat_frames(segment_audio, gaps, assets)
+        if result is not None:
+            parts, duration = result
+            logger.info(f"Assembled {len(segment_audio)} segments by MP3 frame concatenation")
+            if out is None:
+                return b"".join(parts), duration
+            for part in parts:
+                out.write(part)
+            return None, duration
+        if mode == "frames":
+            raise Exception("Segments do not share one MP3 format; cannot concatenate frames")
+        logger.info("Segment formats differ, falling back to PCM assembly")
+    buffer = io.BytesIO() if out is None else None
+    duration = _concat_pcm(segment_audio, gaps, assets, out or buffer)
+    logger.info(f"Assembled {len(segment_audio)} segments by PCM decode and single encode")
+    return (buffer.getvalue() if buffer is not None else None), duration
+
+def encode_rendition(mp3_data, profile, out):
+    """Transcode a finished meditation to one of ENCODING_PROFILES, writing to `out` as it is encoded."""
+    _pipe_through_ffmpeg(["-f", "mp3", "-i", "pipe:0"] + ENCODING_PROFILES[profile]["args"] + ["pipe:1"], mp3_data, out)
@@ -0,0 +1,212 @@
+"""Pre-render a catalog of meditations through the worker queue.
+
+    python batch.py run situations.txt --name spring-catalog
+    python batch.py report --name spring-catalog
+
+Every situation gets a job id derived from the batch name and the text, and
+progress is kept in Redis, so rerunning the same command after a crash (or
+Ctrl-C) skips what is already rendered and only queues the rest. Jobs go to
+the low-priority batch queue under BATCH_USER_ID and never touch credits.
+"""
+from rq.job import Job, JobStatus
+from tasks import get_redis, enqueue_meditation_job, BATCH_QUEUE
+from db import init_db, query_all, execute
+from collections import Counter
+import argparse
+import logging
+import os
+import time
+import uuid
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s] %(message)s')
+logger = logging.getLogger(__name__)
+
+BATCH_USER_ID = os.getenv("BATCH_USER_ID", "catalog")  # owner of pre-rendered meditations
+BATCH_MAX_IN_FLIGHT = int(os.getenv("BATCH_MAX_IN_FLIGHT", 8))  # batch jobs queued or running at once
+BATCH_POLL_INTERVAL = float(os.getenv("BATCH_POLL_INTERVAL", 5))
+
+# Estimated provider prices in USD, only used for the cost report
+OPENAI_INPUT_COST_PER_1K = float(os.getenv("OPENAI_INPUT_COST_PER_1K", 0.0025))
+OPENAI_OUTPUT_COST_PER_1K = float(os.getenv("OPENAI_OUTPUT_COST_PER_1K", 0.01))
+ELEVENLABS_COST_PER_1K_CHARS = float(os.getenv("ELEVENLABS_COST_PER_1K_CHARS", 0.30))
+
+USAGE_FIELDS = ("openai_prompt_tokens", "openai_completion_tokens", "tts_characters", "tts_cached_characters")
+ACTIVE_STATUSES = (JobStatus.QUEUED, JobStatus.STARTED, JobStatus.DEFERRED, JobStatus.SCHEDULED)
+FAILED_STATUSES = (JobStatus.FAILED, JobStatus.STOPPED, JobStatus.CANCELED)
+
+_JOB_NAMESPACE = uuid.UUID("389a7ec0-ce0b-49a0-8214-aca211fd8348")
+
+def _jobs_key(name):
+    return f"batch:{name}:jobs"  # job id -> queued / done / failed
+
+def _stats_key(name):
+    return f"batch:{name}:stats"
+
+def _errors_key(name):
+    return f"batch:{name}:errors"
+
+def read_situations(path):
+    """One situation per line; blank lines, # comments and repeats are skipped."""
+    situations = []
+    seen = set()
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            situation = line.strip()
+            if situation and not situation.startswith("#") and situation not in seen:
+                seen.add(situation)
+                situations.append(situation)
+    return situations
+
+def batch_job_id(name, situation):
+    return str(uuid.uuid5(_JOB_NAMESPACE, f"{name}\n{situation}"))
+
+def ensure_batch_user():
+    execute(
+        "INSERT INTO users (id, email, password, credits) VALUES (:id, NULL, NULL, 0) ON CONFLICT DO NOTHING",
+        {"id": BATCH_USER_ID}
+    )
+
+def rendered_job_ids(job_ids):
+    """The subset of `job_ids` that already have a saved meditation."""
+    rendered = set()
+    for start in range(0, len(job_ids), 500):
+        chunk = job_ids[start:start + 500]
+        params = {f"j{i}": job_id for i, job_id in enumerate(chunk)}
+        params["user_id"] = BATCH_USER_ID
+        placeholders = ", ".join(f":j{i}" for i in range(len(chunk)))
+        rows = query_all(f"SELECT job_id FROM files WHERE user_id = :user_id AND job_id IN ({placeholders})", params)
+        rendered.update(row[0] for row in rows)
+    return rendered
+
+def _record_done(name, job_id, job):
+    redis_conn = get_redis()
+    if redis_conn.hget(_jobs_key(name), job_id) == b"done":
+        return
+    pipe = redis_conn.pipeline()
+    pipe.hset(_jobs_key(name), job_id, "done")
+    pipe.hdel(_errors_key(name), job_id)
+    pipe.hincrby(_stats_key(name), "done", 1)
+    if job is not None:
+        usage = job.meta.get("usage", {})
+        for field in USAGE_FIELDS:
+            if usage.get(field):
+                pipe.hincrby(_stats_key(name), field, int(usage[field]))
+        if job.started_at and job.ended_at:
+            pipe.hincrbyfloat(_stats_key(name), "job_seconds", (job.ended_at - job.started_at).total_seconds())
+    pipe.execute()
+
+def _record_failed(name, job_id, job):
+    error = job.meta.get("error") or f"Job {job.get_status()}"
+    pipe = get_redis().pipeline()
+    pipe.hset(_jobs_key(name), job_id, "failed")
+    pipe.hset(_errors_key(name), job_id, error)
+    pipe.execute()
+    logger.warning(f"Batch job {job_id} failed: {error}")
+
+def run_batch(name, situations, max_in_flight=BATCH_MAX_IN_FLIGHT, retry_failed=False,
+              poll_interval=BATCH_POLL_INTERVAL):
+    """Render every situation not already in the catalog, keeping at most `max_in_flight` jobs queued."""
+    init_db()
+    ensure_batch_user()
+    redis_conn = get_redis()
+    jobs = {batch_job_id(name, situation): situation for situation in situations}
+    statuses = {k.decode(): v.decode() for k, v in redis_conn.hgetall(_jobs_key(name)).items()}
+    rendered = rendered_job_ids(list(jobs))
+
+    pending, in_flight = [], set()
+    for job_id, job in zip(jobs, Job.fetch_many(list(jobs), connection=redis_conn)):
+        if job_id in rendered:
+            _record_done(name, job_id, job)
+        elif job is not None and job.get_status() in ACTIVE_STATUSES:
+            in_flight.add(job_id)  # still queued from an earlier run
+        elif statuses.get(job_id) != "failed" or retry_failed:
+            pending.append(job_id)
+    logger.info(f"Batch {name}: {len(jobs)} situations, {len(rendered)} already rendered, "
+                f"{len(in_flight)} in flight, {len(pending)} to queue")
+
+    started = time.time()
+    finished = failed = 0
+    try:
+        while pending or in_flight:
+            while pending and len(in_flight) < max_in_flight:
+                job_id = pending.pop(0)
+                enqueue_meditation_job(job_id, BATCH_USER_ID, jobs[job_id], queue_name=BATCH_QUEUE, meta={"batch": name})
+                redis_conn.hset(_jobs_key(name), job_id, "queued")
+                in_flight.add(job_id)
+            time.sleep(poll_interval)
+            polled = list(in_flight)
+            for job_id, job in zip(polled, Job.fetch_many(polled, connection=redis_conn)):
+                status = job.get_status() if job is not None else None
+                if status == JobStatus.FINISHED:
+                    _record_done(name, job_id, job)
+                    finished += 1
+                elif status in FAILED_STATUSES:
+                    _record_failed(name, job_id, job)
+                    failed += 1
+                elif job is None:
+                    # Expired from Redis before we saw it finish; the files table has the answer
+                    if rendered_job_ids([job_id]):
+                        _record_done(name, job_id, None)
+                        finished += 1
+                    else:
+                        pending.append(job_id)
+                else:
+                    continue
+                in_flight.discard(job_id)
+            elapsed = time.time() - started
+            logger.info(f"Batch {name}: {finished} done, {failed} failed, {len(in_flight)} in flight, "
+                        f"{len(pending)} waiting, {finished / elapsed * 60:.1f} jobs/min")
+    except KeyboardInterrupt:
+        logger.info(f"Interrupted; queued jobs keep running. Rerun the same command to resume batch {name}")
+    return batch_report(name, run_seconds=time.time() - started, run_finished=finished)
+
+def batch_report(name, run_seconds=None, run_finished=0):
+    """Throughput, estimated cost and failure stats for a batch, as a dict."""
+    redis_conn = get_redis()
+    statuses = Counter(v.decode() for v in redis_conn.hvals(_jobs_key(name)))
+    stats = {k.decode(): float(v) for k, v in redis_conn.hgetall(_stats_key(name)).items()}
+    errors = Counter(v.decode() for v in redis_conn.hvals(_errors_key(name)))
+    done = int(stats.get("done", 0))
+    openai_cost = (stats.get("openai_prompt_tokens", 0) * OPENAI_INPUT_COST_PER_1K
+                   + stats.get("openai_completion_tokens", 0) * OPENAI_OUTPUT_COST_PER_1K) / 1000
+    tts_cost = stats.get("tts_characters", 0) * ELEVENLABS_COST_PER_1K_CHARS / 1000
+    report = {
+        "batch": name,
+        "done": done,
+        "failed": statuses.get("failed", 0),
+        "queued": statuses.get("queued", 0),
+        "avg_job_seconds": stats.get("job_seconds", 0) / done if done else 0.0,
+        "jobs_per_minute": run_finished / run_seconds * 60 if run_seconds else None,
+        "openai_tokens": int(stats.get("openai_prompt_tokens", 0) + stats.get("openai_completion_tokens", 0)),
+        "tts_characters": int(stats.get("tts_characters", 0)),
+        "tts_cached_characters": int(stats.get("tts_cached_characters", 0)),
+        "estimated_cost_usd": round(openai_cost + tts_cost, 2),
+        "cost_per_meditation_usd": round((openai_cost + tts_cost) / done, 4) if done else 0.0,
+        "top_errors": errors.most_common(5),
+    }
+    return report
+
+def print_report(report):
+    for key, value in report.items():
+        if key == "top_errors":
+            for error, count in value:
+                print(f"  {count} x {error}")
+        elif value is not None:
+            print(f"{key}: {round(value, 2) if isinstance(value, float) else value}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pre-render meditations for a list of situations")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run", help="queue every situation in FILE and wait for them")
+    run_parser.add_argument("file", help="text file with one situation per line")
+    run_parser.add_argument("--name", required=True, help="batch name; reuse it to resume")
+    run_parser.add_argument("--max-in-flight", type=int, default=BATCH_MAX_IN_FLIGHT)
+    run_parser.add_argument("--retry-failed", action="store_true", help="queue jobs that failed in earlier runs again")
+    report_parser = commands.add_parser("report", help="print stats for a batch")
+    report_parser.add_argument("--name", required=True)
+    args = parser.parse_args()
+
+    if args.command == "run":
+        print_report(run_batch(args.name, read_situations(args.file), args.max_in_flight, args.retry_failed))
+    else:
+        print_report(batch_report(args.name))
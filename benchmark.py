@@ -0,0 +1,430 @@
+"""Offline load test for the web app and the generation pipeline.
+
+    python benchmark.py --levels 1,4,16 --requests 100
+    python benchmark.py --json baseline.json
+    python benchmark.py --compare baseline.json   # exits 1 on a regression
+
+OpenAI, ElevenLabs and Stripe are replaced by in-process fakes with
+configurable latency and error rates, so no API credits are spent. Each
+concurrency level submits meditations through POST /, drains the queue
+with an in-process RQ worker, then reads the results back through
+/audio/<job_id>, /get_script/<job_id> and the index page. Everything runs
+in a throwaway directory against a fresh SQLite file; Redis is faked with
+fakeredis (pip install fakeredis) unless --redis-url is given.
+"""
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+import argparse
+import json
+import logging
+import os
+import queue
+import random
+import resource
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+BENCH_EMAIL = "bench@example.com"
+BENCH_PASSWORD = "bench"
+
+# A minimal MPEG-1 Layer III header (128 kbps, 44.1 kHz, mono); zero-payload frames decode as silence
+_FRAME_TEMPLATE = bytes([0xFF, 0xFB, 0x90, 0xC0]) + bytes(413)
+TTS_CHARS_PER_SECOND = 15  # how long the fake narration is for a given text
+
+_SENTENCES = [
+    "Settle into a comfortable position and let your eyes gently close.",
+    "Breathe in slowly through your nose, and let the breath out through your mouth.",
+    "Notice the places where your body meets the ground, and let them soften.",
+    "Each breath carries a little more calm into your chest and shoulders.",
+    "If a thought arrives, greet it kindly and let it drift past like a cloud.",
+]
+CANNED_SCRIPT = " [PAUSE 20 SECONDS] ".join(" ".join(_SENTENCES) for _ in range(4))
+
+def configure_environment(workdir, args):
+    """Point the app at throwaway storage and fake keys before it is imported."""
+    os.chdir(workdir)
+    for key in ("OPENAI_API_KEY", "ELEVENLABS_API_KEY", "STRIPE_SECRET_KEY", "STRIPE_PUBLISHABLE_KEY"):
+        os.environ[key] = "bench"
+    os.environ["DATABASE_URL"] = ""
+    os.environ["SQLITE_PATH"] = os.path.join(workdir, "bench.db")
+    os.environ["TTS_CACHE_DIR"] = os.path.join(workdir, "cache", "tts")
+    os.environ["TTS_CACHE_ENABLED"] = "1" if args.tts_cache else "0"
+    os.environ["SCRIPT_CACHE_ENABLED"] = "1" if args.script_cache else "0"
+    os.environ["AUDIO_CONCAT_MODE"] = args.concat_mode
+    os.environ["PIPELINED_GENERATION"] = "1" if args.pipelined else "0"
+    # Every request comes from one bench user; per-user limits would measure the limiter, not the app
+    for key in ("RATE_LIMIT_GENERATE", "RATE_LIMIT_SCRIPT", "RATE_LIMIT_AUDIO", "USER_MAX_IN_FLIGHT"):
+        os.environ[key] = "0"
+
+def synthetic_mp3(seconds):
+    from audio import silent_mp3_frames
+    return silent_mp3_frames(_FRAME_TEMPLATE, seconds * 1000)[0]
+
+class FakeOpenAI:
+    """Stands in for OpenAI(): returns CANNED_SCRIPT after `latency` seconds, streamed or not."""
+
+    def __init__(self, latency=1.0, error_rate=0.0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.chat = SimpleNamespace(completions=self)
+
+    def create(self, messages=None, stream=False, **kwargs):
+        if random.random() < self.error_rate:
+            raise Exception("Fake OpenAI error")
+        usage = SimpleNamespace(prompt_tokens=sum(len(m["content"]) for m in messages) // 4,
+                                completion_tokens=len(CANNED_SCRIPT) // 4)
+        if not stream:
+            time.sleep(self.latency)
+            return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=CANNED_SCRIPT))], usage=usage)
+        return self._stream(usage)
+
+    def _stream(self, usage):
+        pieces = [CANNED_SCRIPT[i:i + 20] for i in range(0, len(CANNED_SCRIPT), 20)]
+        for piece in pieces:
+            time.sleep(self.latency / len(pieces))
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=piece))], usage=None)
+        yield SimpleNamespace(choices=[], usage=usage)
+
+class FakeElevenLabs:
+    """Stands in for ElevenLabs(): streams synthetic MP3 as long as the text would take to read."""
+
+    def __init__(self, latency=0.5, error_rate=0.0):
+        self.latency = latency
+        self.error_rate = error_rate
+
+    def generate(self, text, **kwargs):
+        time.sleep(self.latency)
+        if random.random() < self.error_rate:
+            raise Exception("Fake ElevenLabs error")
+        audio = synthetic_mp3(max(1, len(text) // TTS_CHARS_PER_SECOND))
+        return (audio[i:i + 4096] for i in range(0, len(audio), 4096))
+
+class FakeStripe:
+    """Stands in for the stripe module: Checkout Sessions are created locally, webhooks pass through."""
+
+    def __init__(self):
+        import stripe
+        self.Webhook = stripe.Webhook
+        self.error = stripe.error
+        self.checkout = SimpleNamespace(Session=SimpleNamespace(create=self._create_session))
+
+    def _create_session(self, **kwargs):
+        return SimpleNamespace(id=f"cs_bench_{random.getrandbits(48):x}", url="/success")
+
+class Probe:
+    """Thread-safe collection of timings and counters."""
+
+    def __init__(self):
+        self.timings = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+    def record(self, name, seconds):
+        with self._lock:
+            self.timings.setdefault(name, []).append(seconds)
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    @contextmanager
+    def cpu(self, name):
+        """Record wall time, this thread's CPU time and CPU used by child processes (ffmpeg)."""
+        wall, thread_cpu = time.perf_counter(), time.thread_time()
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        try:
+            yield
+        finally:
+            after = resource.getrusage(resource.RUSAGE_CHILDREN)
+            self.record(f"{name}_wall", time.perf_counter() - wall)
+            self.record(f"{name}_cpu", time.thread_time() - thread_cpu)
+            self.record(f"{name}_ffmpeg_cpu", (after.ru_utime - children.ru_utime) + (after.ru_stime - children.ru_stime))
+
+    def reset(self):
+        with self._lock:
+            self.timings, self.counters = {}, {}
+
+def instrument_pydub(probe):
+    import audio
+    from pydub import AudioSegment
+    from_file, encode_mp3 = AudioSegment.from_file, audio._encode_mp3
+
+    def timed_from_file(cls, *args, **kwargs):
+        with probe.cpu("pydub_decode"):
+            return from_file(*args, **kwargs)
+
+    def timed_encode(segment, out):
+        with probe.cpu("pydub_export"):
+            return encode_mp3(segment, out)
+
+    AudioSegment.from_file = classmethod(timed_from_file)
+    audio._encode_mp3 = timed_encode
+
+def instrument_sqlite(probe):
+    """Time every statement and every BEGIN IMMEDIATE (the write-lock wait), and count lock errors."""
+    import db
+
+    def timed(method):
+        def wrapper(self, sql, params=None):
+            start = time.perf_counter()
+            try:
+                return method(self, sql, params)
+            except sqlite3.OperationalError as e:
+                if "locked" in str(e):
+                    probe.count("sqlite_locked_errors")
+                raise
+            finally:
+                probe.record("sqlite_statement", time.perf_counter() - start)
+        return wrapper
+
+    for name in ("query_one", "query_all", "execute"):
+        setattr(db.SQLiteSession, name, timed(getattr(db.SQLiteSession, name)))
+
+    transaction = db.SQLiteBackend.transaction
+
+    @contextmanager
+    def timed_transaction(self):
+        start = time.perf_counter()
+        try:
+            context = transaction(self)
+            tx = context.__enter__()
+        except sqlite3.OperationalError as e:
+            if "locked" in str(e):
+                probe.count("sqlite_locked_errors")
+            raise
+        probe.record("sqlite_begin_wait", time.perf_counter() - start)
+        try:
+            yield tx
+        except BaseException:
+            if not context.__exit__(*sys.exc_info()):
+                raise
+        else:
+            context.__exit__(None, None, None)
+
+    db.SQLiteBackend.transaction = timed_transaction
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+def summarize(values):
+    return {
+        "count": len(values),
+        "p50_ms": round(percentile(values, 50) * 1000, 2),
+        "p90_ms": round(percentile(values, 90) * 1000, 2),
+        "p99_ms": round(percentile(values, 99) * 1000, 2),
+        "max_ms": round(max(values) * 1000, 2) if values else 0.0,
+    }
+
+def login_clients(flask_app, count):
+    """Logged-in test clients, created up front so password hashing stays out of the timings."""
+    clients = queue.Queue()
+    for _ in range(count):
+        client = flask_app.test_client()
+        client.post("/login", data={"email": BENCH_EMAIL, "password": BENCH_PASSWORD})
+        clients.put(client)
+    return clients
+
+def load_level(clients, concurrency, total, request_fn):
+    """Run `total` calls of request_fn(client, i) from `concurrency` threads; returns stats."""
+    latencies, errors = [], []
+
+    def one(i):
+        client = clients.get()
+        try:
+            start = time.perf_counter()
+            ok = request_fn(client, i)
+            latencies.append(time.perf_counter() - start)
+        finally:
+            clients.put(client)
+        if not ok:
+            errors.append(i)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, range(total)))
+    elapsed = time.perf_counter() - start
+    stats = summarize(latencies)
+    stats.update({"concurrency": concurrency, "errors": len(errors), "rps": round(total / elapsed, 2)})
+    return stats
+
+def post_meditation(client, i):
+    response = client.post("/", data={"situation": f"benchmark situation {i}"})
+    return response.status_code == 202
+
+def get_audio(job_ids):
+    def request_fn(client, i):
+        response = client.get(f"/audio/{random.choice(job_ids)}")
+        response.get_data()
+        response.close()
+        return response.status_code == 200
+    return request_fn
+
+def get_script(job_ids):
+    def request_fn(client, i):
+        return client.get(f"/get_script/{random.choice(job_ids)}").status_code == 200
+    return request_fn
+
+def get_index(client, i):
+    return client.get("/").status_code == 200
+
+def drain_queue(probe):
+    """Run every queued job in this process, one at a time, like a single RQ worker."""
+    from rq import SimpleWorker
+    from rq.registry import FailedJobRegistry
+    from tasks import get_queue, get_redis, DEFAULT_QUEUE, OVERFLOW_QUEUE, BATCH_QUEUE
+
+    queues = [get_queue(name) for name in (DEFAULT_QUEUE, OVERFLOW_QUEUE)]
+    batch_queue = get_queue(BATCH_QUEUE)
+    queued = sum(queue.count for queue in queues)
+    failed_before = sum(FailedJobRegistry(queue=queue).count for queue in queues)
+    start = time.perf_counter()
+    SimpleWorker(queues, connection=get_redis()).work(burst=True, logging_level="WARNING")
+    elapsed = time.perf_counter() - start
+    failed = sum(FailedJobRegistry(queue=queue).count for queue in queues) - failed_before
+    # Rendition encodes and other batch work run afterwards, as on a worker with nothing interactive waiting
+    background = batch_queue.count
+    start = time.perf_counter()
+    SimpleWorker([batch_queue], connection=get_redis()).work(burst=True, logging_level="WARNING")
+    stats = {
+        "jobs": queued,
+        "failed": failed,
+        "seconds": round(elapsed, 2),
+        "jobs_per_minute": round(queued / elapsed * 60, 2) if elapsed else 0.0,
+        "background_jobs": background,
+        "background_seconds": round(time.perf_counter() - start, 2),
+    }
+    for stage in ("pydub_decode", "pydub_export"):
+        for part in ("wall", "cpu", "ffmpeg_cpu"):
+            stats[f"{stage}_{part}_s"] = round(sum(probe.timings.get(f"{stage}_{part}", [])), 3)
+    return stats
+
+def contention_stats(probe):
+    return {
+        "statements": summarize(probe.timings.get("sqlite_statement", [])),
+        "begin_wait": summarize(probe.timings.get("sqlite_begin_wait", [])),
+        "locked_errors": probe.counters.get("sqlite_locked_errors", 0),
+    }
+
+def run(args):
+    workdir = tempfile.mkdtemp(prefix="zenscape-bench-")
+    configure_environment(workdir, args)
+    sys.path.insert(0, REPO_DIR)
+
+    import tasks
+    if args.redis_url:
+        os.environ["REDIS_URL"] = args.redis_url
+    else:
+        import fakeredis
+        tasks._redis_conn = fakeredis.FakeRedis()
+
+    probe = Probe()
+    instrument_sqlite(probe)
+    instrument_pydub(probe)
+
+    from app import create_app
+    from clients import set_clients
+    from db import execute, query_all
+    from werkzeug.security import generate_password_hash
+    flask_app = create_app()
+    logging.getLogger().setLevel(logging.WARNING)
+    set_clients(
+        openai=FakeOpenAI(args.llm_latency, args.llm_error_rate),
+        elevenlabs=FakeElevenLabs(args.tts_latency, args.tts_error_rate),
+        stripe=FakeStripe(),
+    )
+    execute("INSERT INTO users (id, email, password, credits) VALUES (:id, :email, :password, :credits)",
+                {"id": "bench", "email": BENCH_EMAIL, "password": generate_password_hash(BENCH_PASSWORD),
+                 "credits": 10 ** 9})
+
+    results = {"config": vars(args), "levels": []}
+    for level in args.levels:
+        print(f"--- concurrency {level}")
+        probe.reset()
+        level_result = {"concurrency": level, "endpoints": {}}
+        clients = login_clients(flask_app, level)
+        level_result["endpoints"]["POST /"] = load_level(clients, level, args.requests, post_meditation)
+        level_result["pipeline"] = drain_queue(probe)
+        job_ids = [row[0] for row in query_all("SELECT job_id FROM files WHERE user_id = :id", {"id": "bench"})]
+        if job_ids:
+            level_result["endpoints"]["GET /audio"] = load_level(clients, level, args.requests, get_audio(job_ids))
+            level_result["endpoints"]["GET /get_script"] = load_level(clients, level, args.requests, get_script(job_ids))
+        level_result["endpoints"]["GET /"] = load_level(clients, level, args.requests, get_index)
+        level_result["sqlite"] = contention_stats(probe)
+        print_level(level_result)
+        results["levels"].append(level_result)
+    return results
+
+def print_level(level_result):
+    for endpoint, stats in level_result["endpoints"].items():
+        print(f"{endpoint:18} {stats['rps']:>9.1f} req/s  p50 {stats['p50_ms']:>8.1f} ms  "
+              f"p90 {stats['p90_ms']:>8.1f} ms  p99 {stats['p99_ms']:>8.1f} ms  errors {stats['errors']}")
+    pipeline = level_result["pipeline"]
+    print(f"pipeline           {pipeline['jobs_per_minute']:>9.1f} jobs/min ({pipeline['jobs']} jobs, "
+          f"{pipeline['failed']} failed)  pydub cpu {pipeline['pydub_decode_cpu_s'] + pipeline['pydub_export_cpu_s']:.2f} s, "
+          f"ffmpeg cpu {pipeline['pydub_decode_ffmpeg_cpu_s'] + pipeline['pydub_export_ffmpeg_cpu_s']:.2f} s")
+    sqlite_stats = level_result["sqlite"]
+    print(f"sqlite             begin wait p99 {sqlite_stats['begin_wait']['p99_ms']:.1f} ms, "
+          f"statement p99 {sqlite_stats['statements']['p99_ms']:.1f} ms, locked errors {sqlite_stats['locked_errors']}")
+
+def compare(results, baseline, tolerance):
+    """List regressions against a saved run: slower p50, lower throughput or new errors."""
+    regressions = []
+    baseline_levels = {level["concurrency"]: level for level in baseline["levels"]}
+    for level in results["levels"]:
+        base = baseline_levels.get(level["concurrency"])
+        if base is None:
+            continue
+        for endpoint, stats in level["endpoints"].items():
+            old = base["endpoints"].get(endpoint)
+            if old is None:
+                continue
+            if stats["p50_ms"] > old["p50_ms"] * (1 + tolerance):
+                regressions.append(f"{endpoint} @{level['concurrency']}: p50 {old['p50_ms']} -> {stats['p50_ms']} ms")
+            if stats["rps"] < old["rps"] * (1 - tolerance):
+                regressions.append(f"{endpoint} @{level['concurrency']}: {old['rps']} -> {stats['rps']} req/s")
+            if stats["errors"] > old["errors"]:
+                regressions.append(f"{endpoint} @{level['concurrency']}: errors {old['errors']} -> {stats['errors']}")
+        old_rate, new_rate = base["pipeline"]["jobs_per_minute"], level["pipeline"]["jobs_per_minute"]
+        if new_rate < old_rate * (1 - tolerance):
+            regressions.append(f"pipeline @{level['concurrency']}: {old_rate} -> {new_rate} jobs/min")
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline load test with fake OpenAI/ElevenLabs/Stripe backends")
+    parser.add_argument("--levels", type=lambda s: [int(n) for n in s.split(",")], default=[1, 4, 16],
+                        help="comma-separated client concurrency levels")
+    parser.add_argument("--requests", type=int, default=50, help="requests per endpoint per level")
+    parser.add_argument("--llm-latency", type=float, default=1.0)
+    parser.add_argument("--llm-error-rate", type=float, default=0.0)
+    parser.add_argument("--tts-latency", type=float, default=0.5)
+    parser.add_argument("--tts-error-rate", type=float, default=0.0)
+    parser.add_argument("--concat-mode", default="auto", choices=["auto", "frames", "pcm"])
+    parser.add_argument("--pipelined", action=argparse.BooleanOptionalAction, default=True)
+    parser.add_argument("--tts-cache", action="store_true")
+    parser.add_argument("--script-cache", action="store_true")
+    parser.add_argument("--redis-url", help="use a real Redis instead of fakeredis")
+    parser.add_argument("--json", help="write results to this file")
+    parser.add_argument("--compare", help="baseline results file; exit 1 on regression")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown before flagging")
+    args = parser.parse_args()
+
+    output_path = os.path.abspath(args.json) if args.json else None
+    baseline_path = os.path.abspath(args.compare) if args.compare else None
+    results = run(args)
+    if output_path:
+        with open(output_path, "w") as f:
+            json.dump(results, f, indent=2)
+    if baseline_path:
+        with open(baseline_path) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        sys.exit(1 if regressions else 0)
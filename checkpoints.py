@@ -0,0 +1,61 @@
+from tasks import get_redis
+import hashlib
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_TTL = int(os.getenv("CHECKPOINT_TTL", 21600))  # seconds a failed job's progress is kept for its retries
+
+def _key(job_id):
+    return f"checkpoint:{job_id}"
+
+def _segment_field(text):
+    return "segment:" + hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+class JobCheckpoint:
+    """A generation job's finished script and synthesized segments, kept in Redis between attempts.
+
+    Segments are stored under a hash of their text, so a retry reuses them only
+    for the script they were narrated from. Like the caches, this fails open: a
+    Redis error just means the work is redone.
+    """
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+
+    def _save(self, field, value):
+        try:
+            pipe = get_redis().pipeline()
+            pipe.hset(_key(self.job_id), field, value)
+            pipe.expire(_key(self.job_id), CHECKPOINT_TTL)
+            pipe.execute()
+        except Exception as e:
+            logger.warning(f"Failed to checkpoint {field.split(':')[0]} for job {self.job_id}: {str(e)}")
+
+    def _load(self, field):
+        try:
+            return get_redis().hget(_key(self.job_id), field)
+        except Exception as e:
+            logger.warning(f"Failed to read checkpoint for job {self.job_id}: {str(e)}")
+            return None
+
+    def load_script(self):
+        script = self._load("script")
+        return script.decode("utf-8") if script is not None else None
+
+    def save_script(self, script):
+        self._save("script", script)
+
+    def get(self, text):
+        """Checkpointed audio for a segment, or None."""
+        return self._load(_segment_field(text))
+
+    def put(self, text, audio):
+        self._save(_segment_field(text), audio)
+
+    def clear(self):
+        try:
+            get_redis().delete(_key(self.job_id))
+        except Exception as e:
+            logger.warning(f"Failed to clear checkpoint for job {self.job_id}: {str(e)}")
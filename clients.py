@@ -0,0 +1,64 @@
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+# API clients are built on first use, once per process: RQ forks a child per job and gunicorn
+# forks its workers, and neither should inherit (or pay for) connections it never uses.
+_clients = {}
+_clients_lock = threading.Lock()
+
+def _require_env(name):
+    value = os.getenv(name)
+    if not value:
+        logger.error(f"{name} not set in .env")
+        raise ValueError(f"Please set {name} in .env file")
+    return value
+
+def _get(name, build):
+    key = (name, os.getpid())
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = build()
+        return _clients[key]
+
+def get_openai_client():
+    def build():
+        from openai import OpenAI
+        return OpenAI(api_key=_require_env("OPENAI_API_KEY"))
+    return _get("openai", build)
+
+def get_elevenlabs_client():
+    def build():
+        from elevenlabs import ElevenLabs
+        return ElevenLabs(api_key=_require_env("ELEVENLABS_API_KEY"))
+    return _get("elevenlabs", build)
+
+def get_stripe():
+    """The stripe module with the secret key set."""
+    def build():
+        import stripe
+        stripe.api_key = _require_env("STRIPE_SECRET_KEY")
+        return stripe
+    return _get("stripe", build)
+
+def get_s3_client():
+    """boto3 S3 client; S3_ENDPOINT_URL points it at any S3-compatible store (MinIO, R2, ...)."""
+    def build():
+        import boto3
+        return boto3.client(
+            "s3",
+            endpoint_url=os.getenv("S3_ENDPOINT_URL") or None,
+            region_name=os.getenv("S3_REGION") or None,
+            aws_access_key_id=os.getenv("S3_ACCESS_KEY_ID") or None,
+            aws_secret_access_key=os.getenv("S3_SECRET_ACCESS_KEY") or None,
+        )
+    return _get("s3", build)
+
+def set_clients(openai=None, elevenlabs=None, stripe=None, s3=None):
+    """Use the given objects instead of real clients in this process, e.g. fakes in a benchmark."""
+    with _clients_lock:
+        for name, client in (("openai", openai), ("elevenlabs", elevenlabs), ("stripe", stripe), ("s3", s3)):
+            if client is not None:
+                _clients[(name, os.getpid())] = client
@@ -0,0 +1,212 @@
+from contextlib import contextmanager
+import logging
+import os
+import sqlite3
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Set DATABASE_URL (e.g. Heroku Postgres) to share state between dynos through SQLAlchemy;
+# otherwise a local SQLite file is used. All SQL in the app uses :name parameters, which both accept.
+DATABASE_URL = os.getenv("DATABASE_URL", "")
+SQLITE_PATH = os.getenv("SQLITE_PATH", "users.db")
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", 5000))
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 5))
+
+class SQLiteBackend:
+    """One long-lived connection per thread (and per process, since RQ forks).
+
+    Connections run in autocommit mode so single statements hold the write lock
+    only for their own duration; multi-statement work goes through transaction(),
+    which takes the write lock up front with BEGIN IMMEDIATE instead of failing
+    on lock upgrade. sqlite3 keeps compiled statements per connection, so the
+    constant SQL strings used by the app are prepared once per thread.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(
+                self.path,
+                timeout=SQLITE_BUSY_TIMEOUT_MS / 1000,
+                isolation_level=None,
+                cached_statements=256
+            )
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        conn = self.connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield SQLiteSession(conn)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def session(self):
+        return SQLiteSession(self.connection())
+
+    def column_exists(self, table, column):
+        rows = self.connection().execute(f"PRAGMA table_info({table})").fetchall()
+        return column in [row[1] for row in rows]
+
+class SQLiteSession:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def query_one(self, sql, params=None):
+        return self.conn.execute(sql, params or {}).fetchone()
+
+    def query_all(self, sql, params=None):
+        return self.conn.execute(sql, params or {}).fetchall()
+
+    def execute(self, sql, params=None):
+        return self.conn.execute(sql, params or {}).rowcount
+
+class SQLAlchemyBackend:
+    """Pooled connections through SQLAlchemy, for Postgres or any other server database."""
+
+    def __init__(self, url):
+        # Heroku still hands out postgres:// URLs, which SQLAlchemy 2 no longer accepts
+        if url.startswith("postgres://"):
+            url = "postgresql://" + url[len("postgres://"):]
+        self.url = url
+        self._engine = None
+        self._pid = None
+
+    def engine(self):
+        if self._engine is None or self._pid != os.getpid():
+            from sqlalchemy import create_engine
+            self._engine = create_engine(self.url, pool_size=DB_POOL_SIZE, pool_pre_ping=True)
+            self._pid = os.getpid()
+        return self._engine
+
+    @contextmanager
+    def transaction(self):
+        with self.engine().begin() as conn:
+            yield SQLAlchemySession(conn)
+
+    def session(self):
+        return _AutocommitSession(self)
+
+    def column_exists(self, table, column):
+        from sqlalchemy import inspect
+        return column in [c["name"] for c in inspect(self.engine()).get_columns(table)]
+
+class SQLAlchemySession:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def _execute(self, sql, params):
+        from sqlalchemy import text
+        return self.conn.execute(text(sql), params or {})
+
+    def query_one(self, sql, params=None):
+        row = self._execute(sql, params).fetchone()
+        return tuple(row) if row is not None else None
+
+    def query_all(self, sql, params=None):
+        return [tuple(row) for row in self._execute(sql, params).fetchall()]
+
+    def execute(self, sql, params=None):
+        return self._execute(sql, params).rowcount
+
+class _AutocommitSession:
+    """Runs each statement in its own short transaction on a pooled connection."""
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def query_one(self, sql, params=None):
+        with self.backend.transaction() as session:
+            return session.query_one(sql, params)
+
+    def query_all(self, sql, params=None):
+        with self.backend.transaction() as session:
+            return session.query_all(sql, params)
+
+    def execute(self, sql, params=None):
+        with self.backend.transaction() as session:
+            return session.execute(sql, params)
+
+_backend = None
+_backend_lock = threading.Lock()
+
+def get_backend():
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            _backend = SQLAlchemyBackend(DATABASE_URL) if DATABASE_URL else SQLiteBackend(SQLITE_PATH)
+        return _backend
+
+def query_one(sql, params=None):
+    return get_backend().session().query_one(sql, params)
+
+def query_all(sql, params=None):
+    return get_backend().session().query_all(sql, params)
+
+def execute(sql, params=None):
+    """Run one write statement and return the number of rows it affected."""
+    return get_backend().session().execute(sql, params)
+
+def transaction():
+    """Context manager yielding a session whose statements commit or roll back together."""
+    return get_backend().transaction()
+
+def _add_column(backend, table, column, column_type):
+    """Add a column unless it exists. The web app and workers migrate as they start, possibly at once."""
+    try:
+        # On SQLite, BEGIN IMMEDIATE makes the check and the ALTER one step for every process
+        with backend.transaction() as tx:
+            if backend.column_exists(table, column):
+                return
+            tx.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+            if column == "last_played_at":
+                tx.execute("UPDATE files SET last_played_at = created_at")
+    except Exception:
+        # Elsewhere another process can still add it between our check and ALTER ("duplicate column")
+        if not backend.column_exists(table, column):
+            raise
+
+def init_db():
+    backend = get_backend()
+    with backend.transaction() as tx:
+        tx.execute('''CREATE TABLE IF NOT EXISTS users
+                     (id TEXT PRIMARY KEY, email TEXT UNIQUE, password TEXT, credits INTEGER, plan TEXT DEFAULT 'free')''')
+        tx.execute('''CREATE TABLE IF NOT EXISTS files
+                     (id TEXT PRIMARY KEY, user_id TEXT, job_id TEXT, file_path TEXT, situation TEXT, created_at TIMESTAMP,
+                      script TEXT, size_bytes INTEGER, last_played_at TIMESTAMP, evicted_at TIMESTAMP, render_id TEXT,
+                      FOREIGN KEY(user_id) REFERENCES users(id))''')
+        tx.execute('''CREATE TABLE IF NOT EXISTS credit_ledger
+                     (id TEXT PRIMARY KEY, user_id TEXT, delta INTEGER, kind TEXT, ref TEXT, created_at TIMESTAMP,
+                      UNIQUE(kind, ref), FOREIGN KEY(user_id) REFERENCES users(id))''')
+        tx.execute('''CREATE TABLE IF NOT EXISTS stripe_events
+                     (id TEXT PRIMARY KEY, type TEXT, received_at TIMESTAMP)''')
+        tx.execute('''CREATE TABLE IF NOT EXISTS script_cache
+                     (id TEXT PRIMARY KEY, situation_key TEXT, situation_norm TEXT, script TEXT, created_at TIMESTAMP)''')
+        tx.execute('''CREATE TABLE IF NOT EXISTS renditions
+                     (job_id TEXT, profile TEXT, file_path TEXT, size_bytes INTEGER, created_at TIMESTAMP, render_id TEXT,
+                      PRIMARY KEY(job_id, profile))''')
+    # Databases created before these columns existed need them added
+    for table, column, column_type in (("files", "script", "TEXT"), ("files", "size_bytes", "INTEGER"),
+                                       ("files", "last_played_at", "TIMESTAMP"), ("files", "evicted_at", "TIMESTAMP"),
+                                       ("files", "render_id", "TEXT"), ("renditions", "render_id", "TEXT"),
+                                       ("users", "plan", "TEXT DEFAULT 'free'")):
+        _add_column(backend, table, column, column_type)
+    with backend.transaction() as tx:
+        tx.execute("CREATE INDEX IF NOT EXISTS idx_files_job_user ON files(job_id, user_id)")
+        tx.execute("CREATE INDEX IF NOT EXISTS idx_files_user_created ON files(user_id, created_at)")
+        tx.execute("CREATE INDEX IF NOT EXISTS idx_files_last_played ON files(last_played_at)")
+        tx.execute("CREATE INDEX IF NOT EXISTS idx_script_cache_key ON script_cache(situation_key, created_at)")
+        tx.execute("CREATE INDEX IF NOT EXISTS idx_script_cache_created ON script_cache(created_at)")
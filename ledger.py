@@ -0,0 +1,100 @@
+from db import transaction
+from datetime import datetime
+import logging
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# Every change to users.credits is paired with a credit_ledger row in the same transaction.
+# (kind, ref) is unique, which is what makes refunds and purchase grants idempotent.
+RESERVE = "reserve"    # ref = job id, delta -1 when a generation is accepted
+COMMIT = "commit"      # ref = job id, delta 0 once the meditation is saved
+REFUND = "refund"      # ref = job id, delta +1 when the job fails for good
+PURCHASE = "purchase"  # ref = Stripe Checkout Session id
+SIGNUP = "signup"      # ref = user id
+
+_INSERT_ENTRY = (
+    "INSERT INTO credit_ledger (id, user_id, delta, kind, ref, created_at) "
+    "VALUES (:id, :user_id, :delta, :kind, :ref, :created_at) ON CONFLICT DO NOTHING"
+)
+
+def _add_entry(tx, user_id, delta, kind, ref):
+    """Insert a ledger row; returns False if (kind, ref) was already recorded."""
+    return tx.execute(_INSERT_ENTRY, {
+        "id": str(uuid.uuid4()), "user_id": user_id, "delta": delta,
+        "kind": kind, "ref": ref, "created_at": datetime.utcnow()
+    }) == 1
+
+def reserve_credit(user_id, job_id):
+    """Take one credit for a job. Returns the remaining balance, or None if the user has none."""
+    with transaction() as tx:
+        # Single conditional decrement: concurrent submits can never push the balance below zero
+        taken = tx.execute("UPDATE users SET credits = credits - 1 WHERE id = :id AND credits >= 1", {"id": user_id})
+        if taken != 1:
+            return None
+        _add_entry(tx, user_id, -1, RESERVE, job_id)
+        return tx.query_one("SELECT credits FROM users WHERE id = :id", {"id": user_id})[0]
+
+def commit_reservation(job_id):
+    """Mark a job's credit as spent; later refund attempts become no-ops."""
+    with transaction() as tx:
+        row = tx.query_one("SELECT user_id FROM credit_ledger WHERE kind = :kind AND ref = :ref",
+                           {"kind": RESERVE, "ref": job_id})
+        if row:
+            _add_entry(tx, row[0], 0, COMMIT, job_id)
+
+def refund_reservation(job_id):
+    """Give back a job's credit if it was reserved and never committed. Safe to call repeatedly."""
+    with transaction() as tx:
+        row = tx.query_one(
+            "SELECT user_id FROM credit_ledger WHERE kind = :kind AND ref = :ref "
+            "AND NOT EXISTS (SELECT 1 FROM credit_ledger WHERE kind = :commit AND ref = :ref)",
+            {"kind": RESERVE, "commit": COMMIT, "ref": job_id}
+        )
+        if not row or not _add_entry(tx, row[0], 1, REFUND, job_id):
+            return False
+        tx.execute("UPDATE users SET credits = credits + 1 WHERE id = :id", {"id": row[0]})
+    logger.info(f"Refunded credit for job {job_id} to user {row[0]}")
+    return True
+
+def _grant(tx, user_id, amount, kind, ref):
+    if not _add_entry(tx, user_id, amount, kind, ref):
+        return False
+    tx.execute("UPDATE users SET credits = credits + :amount WHERE id = :id", {"amount": amount, "id": user_id})
+    return True
+
+def grant_credits(user_id, amount, kind, ref, tx=None):
+    """Add credits once per (kind, ref). Returns False if this grant was already applied.
+
+    Pass `tx` to make the grant part of a transaction the caller already holds.
+    """
+    if tx is not None:
+        granted = _grant(tx, user_id, amount, kind, ref)
+    else:
+        with transaction() as tx:
+            granted = _grant(tx, user_id, amount, kind, ref)
+    if granted:
+        logger.info(f"Granted {amount} credits to user {user_id} ({kind} {ref})")
+    return granted
+
+def apply_stripe_purchase(event_id, event_type, user_id, amount, checkout_session_id):
+    """Apply a paid checkout from a webhook exactly once.
+
+    The event id guards against Stripe redelivering the same event, and the grant
+    is keyed by the Checkout Session, so a session is only ever paid out once.
+    Returns False if nothing new was applied.
+    """
+    with transaction() as tx:
+        is_new_event = tx.execute(
+            "INSERT INTO stripe_events (id, type, received_at) VALUES (:id, :type, :received_at) ON CONFLICT DO NOTHING",
+            {"id": event_id, "type": event_type, "received_at": datetime.utcnow()}
+        ) == 1
+        if not is_new_event:
+            return False
+        granted = _grant(tx, user_id, amount, PURCHASE, checkout_session_id)
+        if granted:
+            # A verified payment moves the user onto the paid plan's rate limits (see ratelimit.py)
+            tx.execute("UPDATE users SET plan = 'paid' WHERE id = :id", {"id": user_id})
+    if granted:
+        logger.info(f"Granted {amount} credits to user {user_id} for Stripe event {event_id}")
+    return granted
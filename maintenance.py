@@ -0,0 +1,345 @@
+"""Scheduled housekeeping for stored audio, run as an RQ job on the batch queue.
+
+Each pass sweeps leftovers of interrupted writes, records when meditations were
+last played, reconciles the files table with what is actually in storage and
+evicts the least recently played meditations while over a storage quota. Every
+step handles at most MAINTENANCE_BATCH_SIZE items so a pass stays short; the
+next pass carries on. Evicted meditations keep their row and script and are
+rendered again the next time someone plays them.
+
+    python maintenance.py    # run one pass now
+"""
+from rq.exceptions import NoSuchJobError
+from rq.job import Job, JobStatus
+from rq import Callback
+from tasks import (get_redis, get_queue, set_job_stage, fair_queue, release_user_slot, BATCH_QUEUE, JOB_TIMEOUT,
+                   JOB_RESULT_TTL)
+from db import query_all, query_one, execute, transaction
+from storage import get_storage, storage_for, LOCAL_AUDIO_DIR, STORAGE_BACKEND
+from metrics import span
+from script_cache import SCRIPT_CACHE_TTL
+from datetime import datetime, timedelta, timezone
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+MAINTENANCE_INTERVAL = int(os.getenv("MAINTENANCE_INTERVAL", 3600))  # seconds between passes (0 = never schedule)
+MAINTENANCE_BATCH_SIZE = int(os.getenv("MAINTENANCE_BATCH_SIZE", 500))  # items per step per pass
+TEMP_MAX_AGE = int(os.getenv("TEMP_MAX_AGE", 86400))  # seconds before an unfinished write counts as abandoned
+USER_STORAGE_QUOTA_MB = int(os.getenv("USER_STORAGE_QUOTA_MB", 0))  # per user, 0 = unlimited
+GLOBAL_STORAGE_QUOTA_MB = int(os.getenv("GLOBAL_STORAGE_QUOTA_MB", 0))  # all users together, 0 = unlimited
+EVICTION_MIN_IDLE = int(os.getenv("EVICTION_MIN_IDLE", 86400))  # never evict audio played more recently than this
+
+PLAYS_KEY = "audio:last_played"  # sorted set: job_id scored by the time of its latest play
+RECONCILE_CURSOR_KEY = "maintenance:reconcile_cursor"
+LOCK_KEY = "maintenance:lock"
+
+ACTIVE_STATUSES = (JobStatus.QUEUED, JobStatus.STARTED, JobStatus.DEFERRED, JobStatus.SCHEDULED)
+
+# Bytes a meditation takes up in storage, renditions included
+_FILE_BYTES = ("COALESCE(f.size_bytes, 0) + "
+               "COALESCE((SELECT SUM(r.size_bytes) FROM renditions r WHERE r.job_id = f.job_id), 0)")
+
+def record_play(job_id):
+    """Note that a meditation was just played; flushed to files.last_played_at by the next pass."""
+    try:
+        get_redis().zadd(PLAYS_KEY, {job_id: time.time()})
+    except Exception as e:
+        logger.warning(f"Failed to record play for job {job_id}: {str(e)}")
+
+def flush_plays(limit=MAINTENANCE_BATCH_SIZE):
+    redis_conn = get_redis()
+    plays = redis_conn.zpopmin(PLAYS_KEY, limit)
+    if not plays:
+        return 0
+    try:
+        with transaction() as tx:
+            for job_id, played in plays:
+                tx.execute(
+                    "UPDATE files SET last_played_at = :played WHERE job_id = :job_id "
+                    "AND (last_played_at IS NULL OR last_played_at < :played)",
+                    {"job_id": job_id.decode(), "played": datetime.utcfromtimestamp(played)}
+                )
+    except Exception:
+        redis_conn.zadd(PLAYS_KEY, {job_id: played for job_id, played in plays}, gt=True)
+        raise
+    return len(plays)
+
+def sweep_temp_files(limit=MAINTENANCE_BATCH_SIZE):
+    """Remove temp files and abort multipart uploads left behind by crashed writes."""
+    cutoff = time.time() - TEMP_MAX_AGE
+    backends = [storage_for(LOCAL_AUDIO_DIR)]
+    if STORAGE_BACKEND == "s3":
+        backends.append(get_storage())
+    return sum(backend.sweep_temp(cutoff, limit) for backend in backends)
+
+def sweep_script_cache(limit=MAINTENANCE_BATCH_SIZE):
+    """Delete cached scripts older than SCRIPT_CACHE_TTL, which lookups no longer serve."""
+    cutoff = datetime.utcnow() - timedelta(seconds=SCRIPT_CACHE_TTL)
+    return execute(
+        "DELETE FROM script_cache WHERE id IN "
+        "(SELECT id FROM script_cache WHERE created_at < :cutoff LIMIT :limit)",
+        {"cutoff": cutoff, "limit": limit}
+    )
+
+def _referenced(paths):
+    params = {f"p{i}": path for i, path in enumerate(paths)}
+    placeholders = ", ".join(f":p{i}" for i in range(len(paths)))
+    rows = query_all(
+        f"SELECT file_path FROM files WHERE file_path IN ({placeholders}) "
+        f"UNION SELECT file_path FROM renditions WHERE file_path IN ({placeholders})", params
+    )
+    return {row[0] for row in rows}
+
+def sweep_orphaned_audio(limit=MAINTENANCE_BATCH_SIZE):
+    """Delete old local audio files no files or renditions row points at (e.g. a job died before saving)."""
+    if not os.path.isdir(LOCAL_AUDIO_DIR):
+        return 0
+    cutoff = time.time() - TEMP_MAX_AGE
+    removed = 0
+    candidates = []
+
+    def remove_unreferenced():
+        nonlocal removed
+        referenced = _referenced(candidates)
+        for path in candidates:
+            if path not in referenced and removed < limit:
+                os.remove(path)
+                removed += 1
+        candidates.clear()
+
+    with os.scandir(LOCAL_AUDIO_DIR) as entries:
+        for entry in entries:
+            if removed >= limit:
+                break
+            if entry.name.startswith("audio_") and not entry.name.endswith(".tmp") and entry.is_file() \
+                    and entry.stat().st_mtime < cutoff:
+                candidates.append(f"{LOCAL_AUDIO_DIR}/{entry.name}")
+                if len(candidates) == 500:
+                    remove_unreferenced()
+    if candidates:
+        remove_unreferenced()
+    return removed
+
+def reconcile_files(limit=MAINTENANCE_BATCH_SIZE):
+    """Check the next batch of files rows against storage, resuming where the last pass stopped.
+
+    Rows whose audio is gone are marked evicted and kept: with a script they are
+    rendered again on demand, without one /audio answers 404 as before. Missing
+    sizes are filled in and rendition rows without a file are dropped. Rows on
+    local storage this process does not share with the web app are skipped,
+    since the file may well exist on another machine.
+    """
+    redis_conn = get_redis()
+    cursor = (redis_conn.get(RECONCILE_CURSOR_KEY) or b"").decode()
+    rows = query_all(
+        "SELECT id, job_id, user_id, file_path, size_bytes FROM files "
+        "WHERE id > :cursor AND evicted_at IS NULL ORDER BY id LIMIT :limit",
+        {"cursor": cursor, "limit": limit}
+    )
+    stats = {"checked": 0, "skipped": 0, "missing": 0, "sized": 0, "renditions_dropped": 0}
+    checked_jobs = []
+    for file_id, job_id, user_id, file_path, size_bytes in rows:
+        storage = storage_for(file_path or "")
+        if not file_path or not storage.shared:
+            stats["skipped"] += 1
+            continue
+        stats["checked"] += 1
+        checked_jobs.append(job_id)
+        size = storage.size(file_path)
+        if size is None:
+            stats["missing"] += 1
+            logger.warning(f"Audio for job {job_id} is missing from storage ({file_path}), marking it evicted")
+            _mark_evicted(job_id, user_id)
+        elif size != size_bytes:
+            logger.info(f"Recorded size of job {job_id}'s audio as {size} bytes (was {size_bytes})")
+            execute("UPDATE files SET size_bytes = :size WHERE id = :id", {"size": size, "id": file_id})
+            stats["sized"] += 1
+    if checked_jobs:
+        params = {f"j{i}": job_id for i, job_id in enumerate(checked_jobs)}
+        placeholders = ", ".join(f":j{i}" for i in range(len(checked_jobs)))
+        for job_id, profile, file_path in query_all(
+                f"SELECT job_id, profile, file_path FROM renditions WHERE job_id IN ({placeholders})", params):
+            storage = storage_for(file_path)
+            if storage.shared and not storage.exists(file_path):
+                logger.warning(f"Dropping {profile} rendition of job {job_id}: {file_path} is missing")
+                execute("DELETE FROM renditions WHERE job_id = :job_id AND profile = :profile",
+                        {"job_id": job_id, "profile": profile})
+                stats["renditions_dropped"] += 1
+    # Start over from the top once the whole table has been covered
+    redis_conn.set(RECONCILE_CURSOR_KEY, rows[-1][0] if len(rows) == limit else "")
+    return stats
+
+def _mark_evicted(job_id, user_id):
+    with transaction() as tx:
+        tx.execute("DELETE FROM renditions WHERE job_id = :job_id", {"job_id": job_id})
+        tx.execute("UPDATE files SET evicted_at = :now WHERE job_id = :job_id AND user_id = :user_id",
+                   {"now": datetime.utcnow(), "job_id": job_id, "user_id": user_id})
+
+def evict(job_id, user_id, file_path):
+    """Delete a meditation's audio and renditions but keep its row and script for re-rendering."""
+    renditions = [row[0] for row in query_all("SELECT file_path FROM renditions WHERE job_id = :job_id",
+                                              {"job_id": job_id})]
+    # The row goes first so nothing tries to serve audio that is about to disappear
+    _mark_evicted(job_id, user_id)
+    for locator in [file_path] + renditions:
+        try:
+            storage_for(locator).delete(locator)
+        except Exception as e:
+            logger.warning(f"Failed to delete {locator}: {str(e)}")
+    logger.info(f"Evicted audio for job {job_id}")
+
+def _evict_lru(excess, limit, user_id=None):
+    """Evict least recently played meditations until `excess` bytes are freed or `limit` are gone."""
+    params = {"idle_since": datetime.utcfromtimestamp(time.time() - EVICTION_MIN_IDLE), "limit": limit}
+    user_filter = ""
+    if user_id is not None:
+        user_filter = "AND f.user_id = :user_id "
+        params["user_id"] = user_id
+    rows = query_all(
+        f"SELECT f.job_id, f.user_id, f.file_path, {_FILE_BYTES} FROM files f "
+        f"WHERE f.evicted_at IS NULL AND f.script IS NOT NULL AND f.last_played_at < :idle_since {user_filter}"
+        f"ORDER BY f.last_played_at LIMIT :limit", params
+    )
+    evicted = 0
+    for job_id, owner, file_path, size in rows:
+        if excess <= 0:
+            break
+        if not storage_for(file_path).shared:
+            continue  # the file is on another machine's disk; deleting here would only orphan it there
+        evict(job_id, owner, file_path)
+        excess -= size
+        evicted += 1
+    return evicted
+
+def enforce_quotas(limit=MAINTENANCE_BATCH_SIZE):
+    evicted = 0
+    if GLOBAL_STORAGE_QUOTA_MB > 0:
+        used = query_one(f"SELECT COALESCE(SUM({_FILE_BYTES}), 0) FROM files f WHERE f.evicted_at IS NULL")[0]
+        excess = used - GLOBAL_STORAGE_QUOTA_MB * 1024 * 1024
+        if excess > 0:
+            logger.info(f"Storage is {excess / 1024 / 1024:.1f} MB over the global quota")
+            evicted += _evict_lru(excess, limit)
+    if USER_STORAGE_QUOTA_MB > 0:
+        quota = USER_STORAGE_QUOTA_MB * 1024 * 1024
+        over = query_all(
+            f"SELECT f.user_id, SUM({_FILE_BYTES}) FROM files f WHERE f.evicted_at IS NULL "
+            f"GROUP BY f.user_id HAVING SUM({_FILE_BYTES}) > :quota LIMIT :limit",
+            {"quota": quota, "limit": limit}
+        )
+        for user_id, used in over:
+            if evicted >= limit:
+                break
+            evicted += _evict_lru(used - quota, limit - evicted, user_id=user_id)
+    return evicted
+
+def enqueue_rerender(job_id, user_id):
+    """Queue an evicted meditation to be rendered again under its own job id, unless that is already underway.
+
+    The job reports progress through GET /jobs/<job_id> like the original one.
+    """
+    try:
+        job = Job.fetch(job_id, connection=get_redis())
+        if job.get_status() in ACTIVE_STATUSES:
+            return job
+        job.delete()  # the original job's record; its result is long since saved
+    except NoSuchJobError:
+        pass
+    logger.info(f"Queueing re-render of evicted job {job_id}")
+    # Re-renders narrate like new meditations, so they count against the user's fair share too
+    queue_name = fair_queue(user_id, job_id)
+    try:
+        return get_queue(queue_name).enqueue(
+            rerender_meditation,
+            job_id, user_id,
+            job_id=job_id,
+            job_timeout=JOB_TIMEOUT,
+            result_ttl=JOB_RESULT_TTL,
+            failure_ttl=JOB_RESULT_TTL,
+            meta={"stage": "queued", "user_id": user_id},
+            on_failure=Callback(on_rerender_failure)
+        )
+    except Exception:
+        release_user_slot(user_id, job_id)
+        raise
+
+def on_rerender_failure(job, connection, type, value, traceback):
+    """RQ failure callback, which also runs for re-renders that time out or lose their worker."""
+    release_user_slot(job.meta.get("user_id"), job.id)
+
+def rerender_meditation(job_id, user_id):
+    """Narrate and mix an evicted meditation again from its stored script. No credit is charged."""
+    from pipeline import generate_audio
+
+    row = query_one("SELECT script, situation FROM files WHERE job_id = :job_id AND user_id = :user_id",
+                    {"job_id": job_id, "user_id": user_id})
+    try:
+        if not row or not row[0]:
+            raise Exception("No stored script to render from")
+        set_job_stage("synthesizing", script=row[0])
+        audio_path = generate_audio(row[0], job_id, user_id, row[1])
+        set_job_stage("done")
+        return audio_path
+    except Exception as e:
+        logger.error(f"Re-render of job {job_id} failed: {str(e)}")
+        set_job_stage("failed", error=str(e))
+        raise
+    finally:
+        release_user_slot(user_id, job_id)
+
+def run_maintenance():
+    """One maintenance pass. Always schedules the next one, even if a step fails."""
+    redis_conn = get_redis()
+    try:
+        if not redis_conn.set(LOCK_KEY, os.getpid(), nx=True, ex=JOB_TIMEOUT):
+            logger.info("Another maintenance pass is running, skipping this one")
+            return None
+        report = {}
+        try:
+            with span("maintenance"):
+                for step, run in (("temp_files", sweep_temp_files), ("plays", flush_plays),
+                                  ("reconcile", reconcile_files), ("evicted", enforce_quotas),
+                                  ("orphaned_audio", sweep_orphaned_audio), ("script_cache", sweep_script_cache)):
+                    try:
+                        report[step] = run()
+                    except Exception as e:
+                        logger.error(f"Maintenance step {step} failed: {str(e)}")
+                        report[step] = f"error: {str(e)}"
+        finally:
+            redis_conn.delete(LOCK_KEY)
+        logger.info(f"Maintenance pass finished: {report}")
+        return report
+    finally:
+        schedule_maintenance()
+
+def schedule_maintenance():
+    """Schedule the next pass at the next multiple of MAINTENANCE_INTERVAL.
+
+    Every worker calls this at start; the job id is derived from the time slot,
+    so however many call it, each slot runs once.
+    """
+    if MAINTENANCE_INTERVAL <= 0:
+        return None
+    slot = int(time.time() // MAINTENANCE_INTERVAL) + 1
+    job_id = f"maintenance-{slot}"
+    if Job.exists(job_id, connection=get_redis()):
+        return None
+    run_at = datetime.fromtimestamp(slot * MAINTENANCE_INTERVAL, timezone.utc)
+    logger.info(f"Next maintenance pass scheduled for {run_at.isoformat()}")
+    return get_queue(BATCH_QUEUE).enqueue_at(
+        run_at, run_maintenance,
+        job_id=job_id,
+        job_timeout=JOB_TIMEOUT,
+        result_ttl=JOB_RESULT_TTL,
+        failure_ttl=JOB_RESULT_TTL
+    )
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+    load_dotenv()
+    from db import init_db
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s] %(message)s')
+    init_db()
+    print(run_maintenance())
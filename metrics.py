@@ -0,0 +1,147 @@
+from contextlib import contextmanager
+from rq import Queue, Worker
+from rq.registry import StartedJobRegistry, FailedJobRegistry
+from tasks import get_redis, DEFAULT_QUEUE, OVERFLOW_QUEUE, BATCH_QUEUE
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+# Timings are kept in Redis so the web process can report on work done inside forked RQ jobs
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")  # if set, /metrics requires "Authorization: Bearer <token>"
+
+# Upper bounds in seconds; stages range from a DB write to a full meditation
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+STAGE_SECONDS = "zenscape_stage_seconds"
+STAGE_ERRORS = "zenscape_stage_errors_total"
+
+_HELP = {
+    STAGE_SECONDS: ("histogram", "Time spent in each pipeline stage"),
+    STAGE_ERRORS: ("counter", "Pipeline stage runs that raised"),
+}
+
+def _hist_key(name):
+    return f"metrics:hist:{name}"
+
+def _counter_key(name):
+    return f"metrics:counter:{name}"
+
+def _labels(labels):
+    return ",".join(f'{k}="{v}"' for k, v in sorted(labels.items()))
+
+def observe(stage, seconds):
+    """Add one timing to the stage histogram."""
+    if not METRICS_ENABLED:
+        return
+    labels = _labels({"stage": stage})
+    le = next((str(bound) for bound in STAGE_BUCKETS if seconds <= bound), "+Inf")
+    try:
+        pipe = get_redis().pipeline(transaction=False)
+        pipe.hincrby(_hist_key(STAGE_SECONDS), f"{labels}|{le}", 1)
+        pipe.hincrbyfloat(_hist_key(STAGE_SECONDS), f"{labels}|sum", seconds)
+        pipe.hincrby(_hist_key(STAGE_SECONDS), f"{labels}|count", 1)
+        pipe.execute()
+    except Exception as e:
+        logger.warning(f"Failed to record {stage} timing: {str(e)}")
+
+def inc(name, amount=1, **labels):
+    if not METRICS_ENABLED:
+        return
+    try:
+        get_redis().hincrbyfloat(_counter_key(name), _labels(labels), amount)
+    except Exception as e:
+        logger.warning(f"Failed to increment {name}: {str(e)}")
+
+@contextmanager
+def span(stage):
+    """Time the block as `stage`; failures are timed too and counted in the error counter."""
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        inc(STAGE_ERRORS, stage=stage)
+        raise
+    finally:
+        observe(stage, time.perf_counter() - start)
+
+def _format_value(value):
+    # Exact: counters past a million must keep every digit or rate() sees them stall and jump
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+def _format(name, labels, value):
+    return f"{name}{{{labels}}} {_format_value(value)}" if labels else f"{name} {_format_value(value)}"
+
+def _render_histogram(redis_conn, name, lines):
+    series = {}
+    for field, value in redis_conn.hgetall(_hist_key(name)).items():
+        labels, part = field.decode().rsplit("|", 1)
+        series.setdefault(labels, {})[part] = float(value)
+    for labels, parts in sorted(series.items()):
+        cumulative = 0
+        for bound in [str(bound) for bound in STAGE_BUCKETS] + ["+Inf"]:
+            cumulative += parts.get(bound, 0)
+            lines.append(_format(f"{name}_bucket", f'{labels},le="{bound}"', cumulative))
+        lines.append(_format(f"{name}_sum", labels, parts.get("sum", 0)))
+        lines.append(_format(f"{name}_count", labels, parts.get("count", 0)))
+
+def _render_counter(redis_conn, name, lines):
+    for labels, value in sorted(redis_conn.hgetall(_counter_key(name)).items()):
+        lines.append(_format(name, labels.decode(), float(value)))
+
+def _render_queues(redis_conn, lines):
+    lines.append("# TYPE zenscape_queue_depth gauge")
+    lines.append("# TYPE zenscape_queue_started gauge")
+    lines.append("# TYPE zenscape_queue_failed gauge")
+    for name in (DEFAULT_QUEUE, OVERFLOW_QUEUE, BATCH_QUEUE):
+        queue = Queue(name, connection=redis_conn)
+        labels = _labels({"queue": name})
+        lines.append(_format("zenscape_queue_depth", labels, queue.count))
+        lines.append(_format("zenscape_queue_started", labels, StartedJobRegistry(queue=queue).count))
+        lines.append(_format("zenscape_queue_failed", labels, FailedJobRegistry(queue=queue).count))
+
+def _render_workers(redis_conn, lines):
+    """Worker state from RQ's own heartbeats in Redis; utilization is the busy share right now."""
+    workers = Worker.all(connection=redis_conn)
+    busy = sum(1 for worker in workers if worker.get_state() == "busy")
+    lines.append("# TYPE zenscape_workers gauge")
+    lines.append(_format("zenscape_workers", _labels({"state": "busy"}), busy))
+    lines.append(_format("zenscape_workers", _labels({"state": "idle"}), len(workers) - busy))
+    lines.append("# TYPE zenscape_worker_utilization gauge")
+    lines.append(_format("zenscape_worker_utilization", "", busy / len(workers) if workers else 0))
+    lines.append("# TYPE zenscape_worker_working_seconds_total counter")
+    lines.append("# TYPE zenscape_worker_jobs_total counter")
+    for worker in workers:
+        lines.append(_format("zenscape_worker_working_seconds_total", _labels({"worker": worker.name}),
+                             worker.total_working_time or 0))
+        for outcome, count in (("success", worker.successful_job_count), ("failure", worker.failed_job_count)):
+            lines.append(_format("zenscape_worker_jobs_total", _labels({"worker": worker.name, "outcome": outcome}),
+                                 count or 0))
+
+def _render_cache_stats(redis_conn, lines):
+    # Counters the TTS and script caches already keep in Redis
+    for metric, key in (("zenscape_tts_cache_total", "tts:cache:stats"),
+                        ("zenscape_script_cache_total", "script:cache:stats")):
+        lines.append(f"# TYPE {metric} counter")
+        for event, value in sorted(redis_conn.hgetall(key).items()):
+            lines.append(_format(metric, _labels({"event": event.decode()}), float(value)))
+
+def render_metrics():
+    """Everything above in the Prometheus text exposition format."""
+    redis_conn = get_redis()
+    lines = []
+    for name, (kind, help_text) in _HELP.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        if kind == "histogram":
+            _render_histogram(redis_conn, name, lines)
+        else:
+            _render_counter(redis_conn, name, lines)
+    _render_queues(redis_conn, lines)
+    _render_workers(redis_conn, lines)
+    _render_cache_stats(redis_conn, lines)
+    return "\n".join(lines) + "\n"
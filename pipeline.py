@@ -0,0 +1,375 @@
+from clients import get_openai_client, get_elevenlabs_client
+from db import execute, query_one
+from script_cache import get_script_cache
+from tasks import set_job_stage, record_usage, enqueue_renditions_job
+from ratelimit import acquire_openai_tokens
+from metrics import span, observe, inc, STAGE_ERRORS
+from tts import synthesize_segments
+from audio import assemble_meditation, encode_rendition, ENCODING_PROFILES, AUDIO_RENDITIONS
+from streaming import StreamPublisher
+from storage import get_storage
+from collections import Counter
+from datetime import datetime
+import logging
+import os
+import re
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# Scripts mark silent reflection with [PAUSE N SECONDS]; N is capped so one marker cannot stall a meditation
+PAUSE_PATTERN = re.compile(r"\[PAUSE\s+(\d+)\s+SECONDS?\]", re.IGNORECASE)
+MAX_PAUSE_SECONDS = int(os.getenv("MAX_PAUSE_SECONDS", 60))
+# Stream the GPT-4o completion and start narrating each segment as soon as it is written
+PIPELINED_GENERATION = os.getenv("PIPELINED_GENERATION", "1") == "1"
+SCRIPT_MAX_TOKENS = 1000
+
+def clean_text(text):
+    """Remove special characters that may cause issues."""
+    replacements = {
+        '…': '...',
+        '’': "'",
+        '“': '"',
+        '”': '"',
+        '—': '-',
+        '**': '',
+    }
+    for old, new in replacements.items():
+        text = text.replace(old, new)
+    # Square brackets are kept so [PAUSE N SECONDS] markers survive for segmenting
+    text = re.sub(r'[^\w\s.,!?\'"\[\]-]', '', text)
+    return text
+
+def script_messages(situation):
+    prompt = (
+        f"Create a calming meditation script addressing '{situation}'. "
+        "The script should be approximately 5 minutes long (600-750 words) when read at a soothing pace. "
+        "Include 3-4 explicit pauses for silent reflection, each marked as '[PAUSE N SECONDS]' with N between 10 and 30, e.g. '[PAUSE 20 SECONDS]'. "
+        "Keep it soothing, structured with clear breathing instructions, and use a warm, empathetic tone to ease the user's anxiety. "
+        "Avoid special characters like curly quotes, em dashes, or asterisks."
+    )
+    return [
+        {"role": "system", "content": "You are a meditation guide crafting personalized, calming scripts."},
+        {"role": "user", "content": prompt}
+    ]
+
+def acquire_script_budget(messages):
+    """Take a script's worth of tokens from the shared OpenAI budget (prompt estimated at 4 chars/token)."""
+    prompt_chars = sum(len(message["content"]) for message in messages)
+    acquire_openai_tokens(prompt_chars // 4 + SCRIPT_MAX_TOKENS)
+
+def record_openai_usage(usage):
+    if usage is not None:
+        record_usage(openai_prompt_tokens=usage.prompt_tokens, openai_completion_tokens=usage.completion_tokens)
+
+def fallback_script(situation):
+    script = f"""
+        Welcome to your meditation. Find a comfortable position and close your eyes. 
+        Take a deep breath in, and exhale slowly, letting tension slip away. [PAUSE 20 SECONDS]
+        Imagine a serene lake, its surface calm and still. As you breathe in, feel your worries about {situation} soften. 
+        Exhale, releasing them into the water. Let your shoulders relax, your mind ease. 
+        Picture yourself sitting by this lake, the air cool and gentle. Each breath brings calm deeper into your body. [PAUSE 20 SECONDS]
+        Now, visualize a quiet forest path. Each step grounds you, each breath calms you. 
+        Notice the soft sunlight filtering through the trees, warming your face. Feel your anxiety easing, replaced by peace. 
+        You are safe here, held by the earth beneath you. Let your breath flow naturally, slow and steady. [PAUSE 20 SECONDS]
+        Picture a gentle stream, its flow carrying away any remaining stress. 
+        Inhale deeply, filling your lungs with calm. Exhale, letting go completely. 
+        Feel your body light, your mind clear. You are present, at ease, whole. [PAUSE 20 SECONDS]
+        As we close, carry this tranquility with you, knowing you can return here anytime. 
+        Take one final deep breath, and when you are ready, gently open your eyes.
+        """
+    logger.info("Using fallback static script")
+    return clean_text(script)
+
+def pause_ms(seconds):
+    return min(int(seconds), MAX_PAUSE_SECONDS) * 1000
+
+def split_script(script):
+    """Split a script on its pause markers, dropping empty segments.
+
+    Returns (segments, pauses) where pauses[i] is the silence in ms between
+    segments[i] and segments[i + 1]; markers with no text between them add up.
+    """
+    parts = PAUSE_PATTERN.split(script)
+    segments, pauses = [], []
+    pending = 0
+    for i in range(0, len(parts), 2):
+        text = parts[i].strip()
+        if text:
+            if segments:
+                pauses.append(pending)
+            segments.append(text)
+            pending = 0
+        if i + 1 < len(parts):
+            pending += pause_ms(parts[i + 1])
+    return segments, pauses
+
+def lookup_cached_script(situation):
+    cache = get_script_cache()
+    if cache is None:
+        return None
+    try:
+        return cache.lookup(situation)
+    except Exception as e:
+        logger.error(f"Script cache lookup failed: {str(e)}")
+        return None
+
+def store_cached_script(situation, script):
+    cache = get_script_cache()
+    if cache is None:
+        return
+    try:
+        cache.store(situation, script)
+    except Exception as e:
+        logger.error(f"Failed to store script in cache: {str(e)}")
+
+def generate_meditation_script(situation, client=None):
+    """Write a meditation script for `situation`; `client` overrides the OpenAI client (e.g. a stub)."""
+    logger.info(f"Generating meditation script for situation: {situation}")
+    start_time = time.time()
+
+    cached_script = lookup_cached_script(situation)
+    if cached_script:
+        logger.info(f"Reusing cached script in {time.time() - start_time:.2f} seconds")
+        return cached_script
+
+    messages = script_messages(situation)
+    # Outside the try: a job over the OpenAI budget fails and is retried later, not given the fallback script
+    acquire_script_budget(messages)
+    try:
+        with span("script_llm"):
+            response = (client or get_openai_client()).chat.completions.create(
+                model="gpt-4o",
+                messages=messages,
+                max_tokens=SCRIPT_MAX_TOKENS,
+                temperature=0.7
+            )
+        record_openai_usage(getattr(response, "usage", None))
+        script = response.choices[0].message.content.strip()
+        script = clean_text(script)
+        logger.info(f"GPT-4o script generated in {time.time() - start_time:.2f} seconds")
+        store_cached_script(situation, script)
+        return script
+    except Exception as e:
+        logger.error(f"Script generation failed: {str(e)}")
+        return fallback_script(situation)
+
+class ScriptStream:
+    """Yields script segments while GPT-4o is still writing the rest of the script.
+
+    The completion is requested with stream=True and cut at each pause marker as
+    soon as it appears, so TTS for segment 1 overlaps with writing segments 2-4.
+    `pauses` grows alongside, holding the gap before each segment by the time
+    that segment is yielded (the same shape split_script returns).
+    Once the model is done, `script` holds the full cleaned text and
+    `on_complete(script)` is called, before the last segment is yielded, so the
+    script can be checkpointed while its narration is still in flight. If the
+    model fails before the first segment, the fallback script is used instead;
+    a failure after that is raised, since earlier segments are already narrated.
+    Running out of OpenAI budget raises RateLimitExceeded before any request.
+    """
+
+    def __init__(self, situation, client=None, on_complete=None):
+        self.situation = situation
+        self.client = client
+        self.on_complete = on_complete
+        self.script = None
+        self.pauses = []
+
+    def _complete(self, script):
+        self.script = script
+        if self.on_complete is not None:
+            self.on_complete(script)
+
+    def __iter__(self):
+        start_time = time.time()
+        cached_script = lookup_cached_script(self.situation)
+        if cached_script:
+            self._complete(cached_script)
+            yield from self._replay(cached_script)
+            return
+
+        raw_parts = []
+        buffer = ""
+        yielded = 0
+        pending = 0
+        messages = script_messages(self.situation)
+        acquire_script_budget(messages)
+        try:
+            stream = (self.client or get_openai_client()).chat.completions.create(
+                model="gpt-4o",
+                messages=messages,
+                max_tokens=SCRIPT_MAX_TOKENS,
+                temperature=0.7,
+                stream=True,
+                stream_options={"include_usage": True}
+            )
+            for chunk in stream:
+                # With include_usage, the last chunk carries token counts and no choices
+                record_openai_usage(getattr(chunk, "usage", None))
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if not delta:
+                    continue
+                raw_parts.append(delta)
+                buffer += delta
+                match = PAUSE_PATTERN.search(buffer)
+                while match:
+                    segment = clean_text(buffer[:match.start()]).strip()
+                    buffer = buffer[match.end():]
+                    if segment:
+                        if yielded:
+                            self.pauses.append(pending)
+                        else:
+                            logger.info(f"First script segment streamed in {time.time() - start_time:.2f} seconds")
+                            observe("script_first_segment", time.time() - start_time)
+                        pending = 0
+                    pending += pause_ms(match.group(1))
+                    if segment:
+                        yielded += 1
+                        yield segment
+                    match = PAUSE_PATTERN.search(buffer)
+        except Exception as e:
+            inc(STAGE_ERRORS, stage="script_llm")
+            if yielded:
+                raise
+            logger.error(f"Streaming script generation failed: {str(e)}")
+            self._complete(fallback_script(self.situation))
+            yield from self._replay(self.script)
+            return
+
+        logger.info(f"GPT-4o script streamed in {time.time() - start_time:.2f} seconds")
+        observe("script_llm", time.time() - start_time)
+        self._complete(clean_text("".join(raw_parts).strip()))
+        store_cached_script(self.situation, self.script)
+        segment = clean_text(buffer).strip()
+        if segment:
+            if yielded:
+                self.pauses.append(pending)
+            yield segment
+
+    def _replay(self, script):
+        segments, pauses = split_script(script)
+        self.pauses[:] = pauses
+        yield from segments
+
+def stage_on_first_item(items, stage):
+    """Pass `items` through, moving the job to `stage` when the first one arrives."""
+    for i, item in enumerate(items):
+        if i == 0:
+            set_job_stage(stage)
+        yield item
+
+def saved_audio_path(job_id):
+    """The stored meditation for a job, if an earlier attempt got as far as saving it."""
+    row = query_one("SELECT file_path FROM files WHERE job_id = :job_id AND evicted_at IS NULL", {"job_id": job_id})
+    return row[0] if row else None
+
+def new_render_id():
+    """Identifies one write of a file; the same job's audio is rewritten when it is re-rendered or re-encoded."""
+    return uuid.uuid4().hex[:12]
+
+def render_rendition(mp3_data, profile, job_id, user_id):
+    """Encode and store one rendition of a finished meditation, returning its locator."""
+    spec = ENCODING_PROFILES[profile]
+    with span("rendition"), get_storage().writer(f"audio_{user_id}_{job_id}.{profile}.{spec['extension']}",
+                                                 spec["mimetype"]) as out:
+        encode_rendition(mp3_data, profile, out)
+    execute(
+        "INSERT INTO renditions (job_id, profile, file_path, size_bytes, created_at, render_id) "
+        "VALUES (:job_id, :profile, :file_path, :size_bytes, :created_at, :render_id) "
+        "ON CONFLICT(job_id, profile) DO UPDATE SET file_path = excluded.file_path, "
+        "size_bytes = excluded.size_bytes, created_at = excluded.created_at, render_id = excluded.render_id",
+        {"job_id": job_id, "profile": profile, "file_path": out.locator, "size_bytes": out.bytes_written,
+         "created_at": datetime.utcnow(), "render_id": new_render_id()}
+    )
+    logger.info(f"Stored {profile} rendition for job {job_id}: {out.bytes_written / 1024:.0f} KiB")
+    return out.locator
+
+def render_renditions(mp3_data, job_id, user_id, profiles=None):
+    """Encode every configured rendition of a finished meditation.
+
+    A rendition that fails is logged and skipped; the full-quality MP3 is still served.
+    """
+    rendered = {}
+    for profile in AUDIO_RENDITIONS if profiles is None else profiles:
+        try:
+            rendered[profile] = render_rendition(mp3_data, profile, job_id, user_id)
+        except Exception as e:
+            logger.error(f"Failed to render {profile} for job {job_id}: {str(e)}")
+    return rendered
+
+def generate_audio(script, job_id, user_id, situation, checkpoint=None):
+    """Narrate and mix `script`, which is either the full text or a ScriptStream still being written.
+
+    With a `checkpoint`, segments narrated by an earlier attempt are reused and
+    the streamed script is saved once complete, even if narration then fails.
+    """
+    logger.info(f"Starting audio generation for job {job_id}, user {user_id}")
+    start_time = time.time()
+
+    try:
+        if isinstance(script, ScriptStream):
+            # Segments are handed to TTS one by one as the model writes them
+            segments = stage_on_first_item(script, "synthesizing")
+            pauses = script.pauses
+        else:
+            segments, pauses = split_script(script)
+            if not segments:
+                raise Exception("No valid segments found in script")
+            logger.info(f"Found {len(segments)} script segments")
+
+        # Synthesize all segments concurrently; results come back in script order,
+        # and each one is published to the live stream as soon as everything before it is ready
+        publisher = StreamPublisher(job_id, pauses)
+        publisher.reset()  # a retried job starts its live stream over
+        tts_usage = Counter()
+        try:
+            segment_audio = synthesize_segments(get_elevenlabs_client(), segments, job_id, on_segment=publisher.publish,
+                                                usage=tts_usage, checkpoint=checkpoint)
+            publisher.publish_outro()
+        finally:
+            publisher.finish()
+            record_usage(**tts_usage)
+        if isinstance(script, ScriptStream):
+            script = script.script
+        if not segment_audio:
+            raise Exception("No valid segments found in script")
+        set_job_stage("mixing", script=script)
+
+        # Assemble in memory with each marker's pause between segments, encoded at most once and
+        # written to storage as it is produced; nothing is kept if the block raises
+        with span("file_write"), get_storage().writer(f"audio_{user_id}_{job_id}.mp3") as out:
+            _, total_duration = assemble_meditation(segment_audio, pauses, out=out)
+            if total_duration < 60:  # Ensure at least 1 minute
+                raise Exception(f"Generated audio too short: {total_duration:.2f} seconds")
+        audio_path = out.locator
+        logger.info(f"Final audio exported to {audio_path}")
+
+        # Save file metadata to database; a meditation rendered again after eviction keeps its row
+        with span("db_write"):
+            now = datetime.utcnow()
+            params = {"id": str(uuid.uuid4()), "user_id": user_id, "job_id": job_id, "file_path": audio_path,
+                      "situation": situation, "created_at": now, "script": script, "size_bytes": out.bytes_written,
+                      "render_id": new_render_id()}
+            updated = execute(
+                "UPDATE files SET file_path = :file_path, size_bytes = :size_bytes, last_played_at = :created_at, "
+                "evicted_at = NULL, render_id = :render_id WHERE job_id = :job_id AND user_id = :user_id", params
+            )
+            if not updated:
+                execute(
+                    "INSERT INTO files (id, user_id, job_id, file_path, situation, created_at, script, size_bytes, "
+                    "last_played_at, render_id) VALUES (:id, :user_id, :job_id, :file_path, :situation, :created_at, "
+                    ":script, :size_bytes, :created_at, :render_id)",
+                    params
+                )
+        if AUDIO_RENDITIONS:
+            # Smaller encodings are made afterwards so they never delay the meditation itself
+            enqueue_renditions_job(job_id, user_id, audio_path)
+
+        total_time = time.time() - start_time
+        logger.info(f"Audio generation completed for job {job_id} in {total_time:.2f} seconds, total duration: {total_duration:.2f} seconds")
+        return audio_path
+    except Exception as e:
+        logger.error(f"Audio generation failed for job {job_id}: {str(e)}")
+        raise
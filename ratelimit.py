@@ -0,0 +1,124 @@
+from tasks import get_redis
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Provider budgets shared by every web and worker process through Redis (0 = unlimited)
+OPENAI_TOKENS_PER_MINUTE = int(os.getenv("OPENAI_TOKENS_PER_MINUTE", 0))
+ELEVENLABS_CHARS_PER_MINUTE = int(os.getenv("ELEVENLABS_CHARS_PER_MINUTE", 0))
+RATE_LIMIT_MAX_WAIT = float(os.getenv("RATE_LIMIT_MAX_WAIT", 300))  # seconds a caller may block on a budget
+
+# Requests per minute each user may make to a throttled route, by plan: "plan:limit,..." or one number for
+# every plan (0 = unlimited).
+# Plans missing from a route's list get its "free" limit.
+ROUTE_RATE_LIMITS = {
+    "generate": os.getenv("RATE_LIMIT_GENERATE", "free:5,paid:20"),
+    "script": os.getenv("RATE_LIMIT_SCRIPT", "free:60,paid:120"),
+    "audio": os.getenv("RATE_LIMIT_AUDIO", "free:300,paid:600"),
+}
+
+# Refill and take in one round trip. Returns how long to wait before `requested` fits (0 = taken).
+# Floats are returned as strings since Redis truncates Lua numbers to integers.
+_TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local requested = math.min(tonumber(ARGV[4]), capacity)
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or capacity
+local ts = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local wait = 0
+if tokens >= requested then
+    tokens = tokens - requested
+else
+    wait = (requested - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(capacity / rate * 1000) + 1000)
+return tostring(wait)
+"""
+
+class RateLimitExceeded(Exception):
+    pass
+
+class TokenBucket:
+    """A token bucket kept in Redis, so every process draws from the same budget.
+
+    `per_minute` tokens are added continuously up to `burst` (default: one
+    minute's worth). A request larger than the bucket waits for a full bucket
+    rather than forever. If Redis is unreachable the bucket lets calls through.
+    """
+
+    def __init__(self, name, per_minute, burst=None):
+        self.key = f"ratelimit:{name}"
+        self.rate = per_minute / 60
+        self.capacity = burst or per_minute
+
+    def try_acquire(self, amount=1):
+        """Take `amount` tokens if available; returns 0, or the seconds to wait before retrying."""
+        try:
+            wait = get_redis().eval(_TOKEN_BUCKET_SCRIPT, 1, self.key, self.rate, self.capacity, time.time(), amount)
+            return float(wait)
+        except Exception as e:
+            logger.warning(f"Rate limit check on {self.key} failed, allowing request: {str(e)}")
+            return 0
+
+    def acquire(self, amount=1, max_wait=RATE_LIMIT_MAX_WAIT):
+        """Block until `amount` tokens are taken; raises RateLimitExceeded after `max_wait` seconds."""
+        deadline = time.time() + max_wait
+        while True:
+            wait = self.try_acquire(amount)
+            if wait <= 0:
+                return
+            if time.time() + wait > deadline:
+                raise RateLimitExceeded(f"Budget {self.key} exhausted for more than {max_wait:.0f} seconds")
+            time.sleep(wait)
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+def get_bucket(name, per_minute, burst=None):
+    with _buckets_lock:
+        key = (name, per_minute, burst)
+        if key not in _buckets:
+            _buckets[key] = TokenBucket(name, per_minute, burst)
+        return _buckets[key]
+
+def acquire_openai_tokens(amount):
+    if OPENAI_TOKENS_PER_MINUTE > 0:
+        get_bucket("openai:tokens", OPENAI_TOKENS_PER_MINUTE).acquire(amount)
+
+def acquire_elevenlabs_chars(amount):
+    if ELEVENLABS_CHARS_PER_MINUTE > 0:
+        get_bucket("elevenlabs:chars", ELEVENLABS_CHARS_PER_MINUTE).acquire(amount)
+
+def _parse_plan_limits(spec):
+    limits = {}
+    for item in spec.split(","):
+        if item.strip():
+            plan, _, per_minute = item.rpartition(":")
+            # A bare number is the limit for every plan
+            limits[plan.strip() or "free"] = int(per_minute)
+    return limits
+
+_route_limits = {route: _parse_plan_limits(spec) for route, spec in ROUTE_RATE_LIMITS.items()}
+
+def route_limit(route, plan):
+    """Requests per minute allowed on `route` for `plan` (0 = unlimited)."""
+    limits = _route_limits.get(route, {})
+    return limits.get(plan, limits.get("free", 0))
+
+def check_route_limit(route, plan, client):
+    """Count one request by `client` (a user id) to `route`.
+
+    Returns 0 if it is allowed, otherwise the seconds until the next one will be.
+    """
+    per_minute = route_limit(route, plan)
+    if per_minute <= 0:
+        return 0
+    # Not cached like the provider buckets: there is one per client, and building one costs nothing
+    return TokenBucket(f"route:{route}:{client}", per_minute).try_acquire()
@@ -10,6 +10,6 @@ def get_redis_connection():
         port=parsed_url.port,
         username=parsed_url.username,
         password=parsed_url.password,
-        ssl=True,
+        ssl=parsed_url.scheme == "rediss",
         ssl_cert_reqs=None  # Disable verification for Heroku Redis
     )
\ No newline at end of file
@@ -0,0 +1,182 @@
+from db import query_one, query_all, execute
+from tasks import get_redis
+from collections import Counter
+from datetime import datetime, timedelta
+import hashlib
+import logging
+import math
+import os
+import random
+import re
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+SCRIPT_CACHE_ENABLED = os.getenv("SCRIPT_CACHE_ENABLED", "0") == "1"
+# Chance that a cache hit is actually served; the rest generate a fresh script, which keeps variety in the pool
+SCRIPT_REUSE_PROBABILITY = float(os.getenv("SCRIPT_REUSE_PROBABILITY", 0.8))
+SCRIPT_CACHE_TTL = int(os.getenv("SCRIPT_CACHE_TTL", 7 * 86400))  # seconds a stored script stays reusable
+SCRIPT_SIMILARITY_THRESHOLD = float(os.getenv("SCRIPT_SIMILARITY_THRESHOLD", 0.75))  # trigram cosine
+SCRIPT_CACHE_MAX_ENTRIES = int(os.getenv("SCRIPT_CACHE_MAX_ENTRIES", 5000))  # newest entries kept in the local index
+SCRIPT_CACHE_REFRESH_INTERVAL = 60  # seconds between pulls of scripts stored by other processes
+
+SCRIPT_CACHE_STATS_KEY = "script:cache:stats"
+
+_STOPWORDS = {
+    "a", "an", "the", "my", "me", "i", "im", "am", "about", "of", "for", "to", "in", "on", "at", "with",
+    "and", "or", "so", "really", "very", "feel", "feeling", "felt", "before", "after", "some", "this", "that",
+}
+
+def normalize_situation(text):
+    """Lowercase and drop punctuation and filler words so trivial rephrasings hash the same."""
+    words = re.sub(r"[^a-z0-9\s]", " ", (text or "").lower().replace("'", "")).split()
+    return " ".join(word for word in words if word not in _STOPWORDS)
+
+def situation_key(normalized):
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+def trigram_vector(normalized):
+    padded = f" {normalized} "
+    return Counter(padded[i:i + 3] for i in range(len(padded) - 2))
+
+def cosine(a, b):
+    if not a or not b:
+        return 0.0
+    dot = sum(count * b[gram] for gram, count in a.items() if gram in b)
+    return dot / (math.sqrt(sum(v * v for v in a.values())) * math.sqrt(sum(v * v for v in b.values())))
+
+class ScriptCache:
+    """Reuse GPT-4o scripts across users whose situations are (nearly) the same.
+
+    Lookups try the exact normalized-situation hash in the database first, then
+    the nearest neighbour in a local trigram index built from recent scripts.
+    Everything stored is in the script_cache table, so all processes share hits;
+    each process only keeps the small vector index in memory.
+    """
+
+    def __init__(self, reuse_probability=SCRIPT_REUSE_PROBABILITY, ttl=SCRIPT_CACHE_TTL,
+                 threshold=SCRIPT_SIMILARITY_THRESHOLD, max_entries=SCRIPT_CACHE_MAX_ENTRIES, rng=None):
+        self.reuse_probability = reuse_probability
+        self.ttl = ttl
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.rng = rng or random.Random()
+        self.vectors = {}
+        self.postings = {}
+        self.loaded_until = None
+        self.last_refresh = 0
+        self.counters = Counter()
+        self._lock = threading.Lock()
+
+    def _cutoff(self):
+        return datetime.utcnow() - timedelta(seconds=self.ttl)
+
+    def _index(self, entry_id, normalized):
+        vector = trigram_vector(normalized)
+        self.vectors[entry_id] = vector
+        for gram in vector:
+            self.postings.setdefault(gram, set()).add(entry_id)
+
+    def _refresh(self):
+        """Pull scripts stored since the last refresh (by any process) into the local index."""
+        if time.time() - self.last_refresh < SCRIPT_CACHE_REFRESH_INTERVAL:
+            return
+        since = self.loaded_until or self._cutoff()
+        rows = query_all(
+            "SELECT id, situation_norm, created_at FROM script_cache WHERE created_at > :since "
+            "ORDER BY created_at DESC LIMIT :limit", {"since": since, "limit": self.max_entries}
+        )
+        for entry_id, normalized, _ in rows:
+            self._index(entry_id, normalized)
+        if rows:
+            self.loaded_until = rows[0][2]
+        if len(self.vectors) > self.max_entries:
+            # Rebuild from the newest entries only; older ones are past their useful life anyway
+            self.vectors, self.postings, self.loaded_until = {}, {}, None
+            self.last_refresh = 0
+            return self._refresh()
+        self.last_refresh = time.time()
+
+    def _nearest(self, normalized):
+        vector = trigram_vector(normalized)
+        candidates = set()
+        for gram in vector:
+            candidates |= self.postings.get(gram, set())
+        best_id, best_score = None, 0.0
+        for entry_id in candidates:
+            score = cosine(vector, self.vectors[entry_id])
+            if score > best_score:
+                best_id, best_score = entry_id, score
+        return (best_id, best_score) if best_score >= self.threshold else (None, best_score)
+
+    def lookup(self, situation):
+        """Return a cached script for this situation, or None to generate a fresh one."""
+        normalized = normalize_situation(situation)
+        if not normalized:
+            return None
+        cutoff = self._cutoff()
+        row = query_one(
+            "SELECT script FROM script_cache WHERE situation_key = :key AND created_at >= :cutoff "
+            "ORDER BY created_at DESC LIMIT 1", {"key": situation_key(normalized), "cutoff": cutoff}
+        )
+        kind = "exact_hits"
+        if not row:
+            with self._lock:
+                self._refresh()
+                entry_id, score = self._nearest(normalized)
+            if entry_id:
+                row = query_one("SELECT script FROM script_cache WHERE id = :id AND created_at >= :cutoff",
+                                {"id": entry_id, "cutoff": cutoff})
+                kind = "similar_hits"
+                logger.info(f"Script cache similarity match {score:.2f} for situation: {situation}")
+        if not row:
+            self._record("misses")
+            return None
+        if self.rng.random() >= self.reuse_probability:
+            self._record("bypassed")
+            return None
+        self._record(kind)
+        return row[0]
+
+    def store(self, situation, script):
+        normalized = normalize_situation(situation)
+        if not normalized:
+            return
+        entry_id = str(uuid.uuid4())
+        execute(
+            "INSERT INTO script_cache (id, situation_key, situation_norm, script, created_at) "
+            "VALUES (:id, :key, :norm, :script, :created_at)",
+            {"id": entry_id, "key": situation_key(normalized), "norm": normalized,
+             "script": script, "created_at": datetime.utcnow()}
+        )
+        with self._lock:
+            self._index(entry_id, normalized)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+        hits = stats.get("exact_hits", 0) + stats.get("similar_hits", 0)
+        lookups = hits + stats.get("misses", 0) + stats.get("bypassed", 0)
+        stats["hit_rate"] = hits / lookups if lookups else 0.0
+        return stats
+
+    def _record(self, counter):
+        with self._lock:
+            self.counters[counter] += 1
+        try:
+            get_redis().hincrby(SCRIPT_CACHE_STATS_KEY, counter, 1)
+        except Exception as e:
+            logger.warning(f"Script cache Redis call failed: {str(e)}")
+
+_script_cache = None
+
+def get_script_cache():
+    """Return the process-wide script cache, or None when reuse is disabled."""
+    global _script_cache
+    if not SCRIPT_CACHE_ENABLED:
+        return None
+    if _script_cache is None:
+        _script_cache = ScriptCache()
+    return _script_cache
@@ -0,0 +1,247 @@
+from clients import get_s3_client
+from contextlib import contextmanager
+import logging
+import os
+import threading
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# "local" keeps audio on this machine's disk; "s3" uses any S3-compatible bucket (set S3_ENDPOINT_URL for MinIO)
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "local").lower()
+LOCAL_AUDIO_DIR = "static/audio"
+# Set when the web app and every worker see the same static/audio (one machine, or a shared volume).
+# Separate dynos each have their own disk, so nothing but the process that wrote a local file can see it
+LOCAL_STORAGE_SHARED = os.getenv("LOCAL_STORAGE_SHARED", "0") == "1"
+S3_BUCKET = os.getenv("S3_BUCKET", "")
+S3_PREFIX = os.getenv("S3_PREFIX", "audio/")
+S3_PART_SIZE = max(int(os.getenv("S3_PART_SIZE_MB", 8)), 5) * 1024 * 1024  # S3 rejects parts under 5 MB
+AUDIO_URL_TTL = int(os.getenv("AUDIO_URL_TTL", 300))  # seconds a presigned audio URL stays valid
+
+class LocalStorage:
+    """Files under `root`; locators are the relative paths stored in files.file_path since day one."""
+
+    def __init__(self, root=LOCAL_AUDIO_DIR, shared=LOCAL_STORAGE_SHARED):
+        self.root = root
+        self.shared = shared  # whether other processes see the same files; a missing file proves nothing otherwise
+
+    def locator(self, key):
+        return f"{self.root}/{key}"
+
+    @contextmanager
+    def writer(self, key, content_type="audio/mpeg"):
+        """Yield a writable file; it appears under `key` only if the block completes."""
+        os.makedirs(self.root, exist_ok=True)
+        path = self.locator(key)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                writer = _Writer(f, self.locator(key))
+                yield writer
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def put(self, key, data, content_type="audio/mpeg"):
+        with self.writer(key, content_type) as f:
+            f.write(data)
+        return self.locator(key)
+
+    def read(self, locator):
+        with open(locator, "rb") as f:
+            return f.read()
+
+    def exists(self, locator):
+        return os.path.exists(locator)
+
+    def size(self, locator):
+        return os.path.getsize(locator) if os.path.exists(locator) else None
+
+    def delete(self, locator):
+        if os.path.exists(locator):
+            os.remove(locator)
+
+    def sweep_temp(self, cutoff, limit):
+        """Delete up to `limit` leftovers of interrupted writes modified before `cutoff` (a timestamp).
+
+        Covers this module's .tmp files and the segment_/silence_ files older
+        versions of the pipeline wrote next to the audio.
+        """
+        removed = 0
+        if not os.path.isdir(self.root):
+            return removed
+        with os.scandir(self.root) as entries:
+            for entry in entries:
+                if removed >= limit:
+                    break
+                name = entry.name
+                if not (name.endswith(".tmp") or name.startswith(("segment_", "silence_"))):
+                    continue
+                try:
+                    if entry.is_file() and entry.stat().st_mtime < cutoff:
+                        os.remove(entry.path)
+                        removed += 1
+                except OSError as e:
+                    logger.warning(f"Failed to remove {entry.path}: {str(e)}")
+        return removed
+
+    def presigned_url(self, locator, filename=None, expires=AUDIO_URL_TTL):
+        return None  # served by the app (or the proxy, via AUDIO_OFFLOAD)
+
+class S3Storage:
+    """Objects in one bucket; locators look like s3://bucket/key."""
+
+    def __init__(self, bucket=S3_BUCKET, prefix=S3_PREFIX):
+        if not bucket:
+            raise ValueError("Please set S3_BUCKET in .env file")
+        self.bucket = bucket
+        self.prefix = prefix
+        self.shared = True
+
+    def locator(self, key):
+        return f"s3://{self.bucket}/{self.prefix}{key}"
+
+    def _split(self, locator):
+        bucket, _, key = locator[len("s3://"):].partition("/")
+        return bucket, key
+
+    @contextmanager
+    def writer(self, key, content_type="audio/mpeg"):
+        """Yield a writer that uploads in S3_PART_SIZE parts as data arrives; aborted if the block raises."""
+        upload = _MultipartUpload(get_s3_client(), self.bucket, self.prefix + key, content_type, self.locator(key))
+        try:
+            yield upload
+            upload.complete()
+        except BaseException:
+            upload.abort()
+            raise
+
+    def put(self, key, data, content_type="audio/mpeg"):
+        get_s3_client().put_object(Bucket=self.bucket, Key=self.prefix + key, Body=data, ContentType=content_type)
+        return self.locator(key)
+
+    def read(self, locator):
+        bucket, key = self._split(locator)
+        return get_s3_client().get_object(Bucket=bucket, Key=key)["Body"].read()
+
+    def exists(self, locator):
+        return self.size(locator) is not None
+
+    def size(self, locator):
+        bucket, key = self._split(locator)
+        try:
+            return get_s3_client().head_object(Bucket=bucket, Key=key)["ContentLength"]
+        except Exception as e:
+            if getattr(e, "response", {}).get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return None
+            raise
+
+    def delete(self, locator):
+        bucket, key = self._split(locator)
+        get_s3_client().delete_object(Bucket=bucket, Key=key)
+
+    def sweep_temp(self, cutoff, limit):
+        """Abort up to `limit` multipart uploads under the prefix started before `cutoff` (a timestamp)."""
+        client = get_s3_client()
+        uploads = client.list_multipart_uploads(Bucket=self.bucket, Prefix=self.prefix, MaxUploads=limit).get("Uploads", [])
+        aborted = 0
+        for upload in uploads:
+            if upload["Initiated"].timestamp() < cutoff:
+                client.abort_multipart_upload(Bucket=self.bucket, Key=upload["Key"], UploadId=upload["UploadId"])
+                aborted += 1
+        return aborted
+
+    def presigned_url(self, locator, filename=None, expires=AUDIO_URL_TTL):
+        bucket, key = self._split(locator)
+        params = {"Bucket": bucket, "Key": key}
+        if filename:
+            params["ResponseContentDisposition"] = f'inline; filename="{filename}"'
+        return get_s3_client().generate_presigned_url("get_object", Params=params, ExpiresIn=expires)
+
+class _Writer:
+    def __init__(self, f, locator):
+        self.f = f
+        self.locator = locator
+        self.bytes_written = 0
+
+    def write(self, data):
+        self.f.write(data)
+        self.bytes_written += len(data)
+        return len(data)
+
+class _MultipartUpload:
+    """File-like sink that turns writes into an S3 multipart upload.
+
+    Nothing is sent until S3_PART_SIZE bytes are buffered; output smaller than
+    one part becomes a single PUT instead.
+    """
+
+    def __init__(self, client, bucket, key, content_type, locator):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.content_type = content_type
+        self.locator = locator
+        self.buffer = bytearray()
+        self.upload_id = None
+        self.parts = []
+        self.bytes_written = 0
+
+    def write(self, data):
+        self.buffer += data
+        self.bytes_written += len(data)
+        while len(self.buffer) >= S3_PART_SIZE:
+            self._upload_part(bytes(self.buffer[:S3_PART_SIZE]))
+            del self.buffer[:S3_PART_SIZE]
+        return len(data)
+
+    def _upload_part(self, data):
+        if self.upload_id is None:
+            self.upload_id = self.client.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key, ContentType=self.content_type
+            )["UploadId"]
+        number = len(self.parts) + 1
+        response = self.client.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                           PartNumber=number, Body=data)
+        self.parts.append({"PartNumber": number, "ETag": response["ETag"]})
+
+    def complete(self):
+        if self.upload_id is None:
+            self.client.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self.buffer), ContentType=self.content_type)
+            return
+        if self.buffer:
+            self._upload_part(bytes(self.buffer))
+        self.client.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                              MultipartUpload={"Parts": self.parts})
+
+    def abort(self):
+        if self.upload_id is None:
+            return
+        try:
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+        except Exception as e:
+            logger.warning(f"Failed to abort upload of {self.key}: {str(e)}")
+
+_storages = {}
+_storages_lock = threading.Lock()
+
+def get_storage():
+    """The backend new audio is written to."""
+    with _storages_lock:
+        if STORAGE_BACKEND not in _storages:
+            _storages[STORAGE_BACKEND] = S3Storage() if STORAGE_BACKEND == "s3" else LocalStorage()
+        return _storages[STORAGE_BACKEND]
+
+def storage_for(locator):
+    """The backend holding an existing file, whatever STORAGE_BACKEND is now (older rows keep local paths)."""
+    if locator.startswith("s3://"):
+        bucket = locator[len("s3://"):].partition("/")[0]
+        with _storages_lock:
+            key = ("s3", bucket)
+            if key not in _storages:
+                _storages[key] = S3Storage(bucket=bucket)
+            return _storages[key]
+    with _storages_lock:
+        return _storages.setdefault("local", LocalStorage())
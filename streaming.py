@@ -0,0 +1,137 @@
+from audio import split_mp3_frames, get_assets
+from tasks import get_redis, get_job_status, JOB_TIMEOUT
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+STREAM_TTL = int(os.getenv("STREAM_TTL", 900))  # seconds a live stream stays readable in Redis
+STREAM_POLL_INTERVAL = float(os.getenv("STREAM_POLL_INTERVAL", 0.25))
+
+def _chunks_key(job_id):
+    return f"stream:{job_id}:chunks"
+
+def _done_key(job_id):
+    return f"stream:{job_id}:done"
+
+class StreamPublisher:
+    """Publishes a job's narration to Redis as playable MP3 frames, in script order.
+
+    Segments finish out of order on the TTS pool, so each one is held until
+    every earlier segment has been published. The pause before segment i is
+    read from `pauses[i - 1]` when the segment goes out, so a list that is still
+    being filled in by a ScriptStream works; this matches the final mix without
+    knowing up front how many segments there will be. Chimes are streamed when
+    they share the narration's MP3 format; ambience is only in the final file.
+    """
+
+    def __init__(self, job_id, pauses):
+        self.job_id = job_id
+        self.pauses = pauses
+        self.pending = {}
+        self.next_index = 0
+        self.stream_format = None
+        self.enabled = True
+        self._lock = threading.Lock()
+
+    def reset(self):
+        """Drop anything an earlier attempt at this job published."""
+        try:
+            get_redis().delete(_chunks_key(self.job_id), _done_key(self.job_id))
+        except Exception as e:
+            logger.warning(f"Failed to reset stream for job {self.job_id}: {str(e)}")
+
+    def publish(self, index, audio):
+        with self._lock:
+            self.pending[index] = audio
+            while self.enabled and self.next_index in self.pending:
+                self._push(self.next_index, self.pending.pop(self.next_index))
+                self.next_index += 1
+
+    def _push(self, index, audio):
+        frame_format, frames = split_mp3_frames(audio)
+        if not frames or (self.stream_format is not None and frame_format != self.stream_format):
+            # The browser can only play one continuous MP3 format; the final file still gets built
+            logger.warning(f"Segment {index} of job {self.job_id} cannot be streamed, stopping live stream")
+            self.enabled = False
+            return
+        self.stream_format = frame_format
+        assets = get_assets()
+        chunks = []
+        if index == 0:
+            intro = assets.clip_frames("intro")
+            if intro is not None and intro[0] == frame_format:
+                chunks.append(intro[1])
+        pause_ms = self.pauses[index - 1] if 0 < index <= len(self.pauses) else 0
+        if pause_ms > 0:
+            chunks.append(assets.silence_frames(frames[0], pause_ms)[0])
+        chunks.append(b"".join(frames))
+        self._send(chunks, f"segment {index}")
+
+    def _send(self, chunks, label):
+        try:
+            pipe = get_redis().pipeline()
+            pipe.rpush(_chunks_key(self.job_id), *chunks)
+            pipe.expire(_chunks_key(self.job_id), STREAM_TTL)
+            pipe.execute()
+            logger.info(f"Streamed {label} for job {self.job_id}")
+        except Exception as e:
+            logger.warning(f"Failed to stream {label} for job {self.job_id}: {str(e)}")
+            self.enabled = False
+
+    def publish_outro(self):
+        """Append the outro chime once every segment has been published."""
+        outro = get_assets().clip_frames("outro")
+        with self._lock:
+            if self.enabled and outro is not None and outro[0] == self.stream_format:
+                self._send([outro[1]], "outro")
+
+    def finish(self):
+        """Mark the stream complete so readers stop waiting for more audio."""
+        try:
+            get_redis().set(_done_key(self.job_id), 1, ex=STREAM_TTL)
+        except Exception as e:
+            logger.warning(f"Failed to close stream for job {self.job_id}: {str(e)}")
+
+def stream_available(job_id):
+    """Whether a job has live audio to play; chunks are gone once STREAM_TTL has passed."""
+    try:
+        return bool(get_redis().exists(_chunks_key(job_id)))
+    except Exception as e:
+        logger.warning(f"Failed to check live stream for job {job_id}: {str(e)}")
+        return False
+
+def iter_stream(job_id):
+    """Yield a job's MP3 chunks as they are published, until the stream is finished.
+
+    Each listener holds a web thread, so this also stops as soon as the job
+    itself ends: a job killed before it could mark the stream done, or one
+    being retried (its stream starts over), would otherwise keep the thread
+    polling until JOB_TIMEOUT.
+    """
+    redis_conn = get_redis()
+    position = 0
+    deadline = time.time() + JOB_TIMEOUT
+    while time.time() < deadline:
+        # Read the done flag first so chunks pushed just before it are not missed
+        done = redis_conn.exists(_done_key(job_id))
+        chunks = redis_conn.lrange(_chunks_key(job_id), position, -1)
+        for chunk in chunks:
+            yield chunk
+        position += len(chunks)
+        if done and not chunks:
+            return
+        if not chunks:
+            status = get_job_status(job_id)
+            stage = status["stage"] if status else None
+            if stage in (None, "failed", "retrying"):
+                logger.info(f"Live stream for job {job_id} ended with the job ({stage or 'expired'})")
+                return
+            if stage == "done":
+                # Finished with no done flag left: the stream expired, or was completed just now
+                yield from redis_conn.lrange(_chunks_key(job_id), position, -1)
+                return
+            time.sleep(STREAM_POLL_INTERVAL)
+    logger.warning(f"Live stream for job {job_id} timed out")
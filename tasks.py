@@ -0,0 +1,232 @@
+from rq import Callback, Queue, Retry, get_current_job
+from rq.job import Job, JobStatus
+from rq.exceptions import NoSuchJobError
+from redis_config import get_redis_connection
+from ledger import commit_reservation, refund_reservation
+from datetime import datetime, timezone
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+# Stages reported by GET /jobs/<job_id>, in pipeline order; "retrying" means an attempt failed and another is due
+JOB_STAGES = ("queued", "scripting", "synthesizing", "mixing", "retrying", "done", "failed")
+
+JOB_TIMEOUT = int(os.getenv("JOB_TIMEOUT", 600))  # seconds a worker may spend on one meditation
+JOB_RESULT_TTL = int(os.getenv("JOB_RESULT_TTL", 86400))  # keep status around for a day
+# A failed or abandoned (worker crashed, deploy) job is run again after each interval; retries resume from
+# the job's checkpoint, and the credit is only refunded once the last one fails
+JOB_MAX_RETRIES = int(os.getenv("JOB_MAX_RETRIES", 2))
+JOB_RETRY_INTERVALS = [int(seconds) for seconds in os.getenv("JOB_RETRY_INTERVALS", "30,120").split(",") if seconds.strip()]
+
+# Workers drain the default (interactive) queue before touching bulk catalog renders and rendition encodes
+DEFAULT_QUEUE = "default"
+OVERFLOW_QUEUE = "overflow"  # a user's meditations beyond their fair share, run when no other user is waiting
+BATCH_QUEUE = "batch"
+
+USER_MAX_IN_FLIGHT = int(os.getenv("USER_MAX_IN_FLIGHT", 2))  # a user's jobs on the default queue at once (0 = no cap)
+# A slot whose job never reported back (its worker was killed) is reclaimed once every attempt could have run
+USER_SLOT_TTL = JOB_TIMEOUT * (JOB_MAX_RETRIES + 2) + sum(JOB_RETRY_INTERVALS)
+
+_redis_conn = None
+
+def get_redis():
+    """Return the process-wide Redis connection (its pool is shared by all callers)."""
+    global _redis_conn
+    if _redis_conn is None:
+        _redis_conn = get_redis_connection()
+    return _redis_conn
+
+def get_queue(name=DEFAULT_QUEUE):
+    return Queue(name, connection=get_redis())
+
+def _user_slots_key(user_id):
+    return f"inflight:{user_id}"
+
+def claim_user_slot(user_id, job_id):
+    """Count a job against its user's share of the default queue; False if the share is used up.
+
+    Like the TTS slots, this fails open: without Redis every job counts as fair.
+    """
+    if USER_MAX_IN_FLIGHT <= 0:
+        return True
+    key = _user_slots_key(user_id)
+    now = time.time()
+    try:
+        redis_conn = get_redis()
+        pipe = redis_conn.pipeline()
+        pipe.zremrangebyscore(key, 0, now - USER_SLOT_TTL)
+        pipe.zadd(key, {job_id: now})
+        pipe.zrank(key, job_id)
+        pipe.expire(key, USER_SLOT_TTL)
+        rank = pipe.execute()[2]
+        if rank is not None and rank < USER_MAX_IN_FLIGHT:
+            return True
+        redis_conn.zrem(key, job_id)
+        return False
+    except Exception as e:
+        logger.warning(f"Failed to count job {job_id} against user {user_id}'s share: {str(e)}")
+        return True
+
+def release_user_slot(user_id, job_id):
+    try:
+        get_redis().zrem(_user_slots_key(user_id), job_id)
+    except Exception as e:
+        logger.warning(f"Failed to release user {user_id}'s slot for job {job_id}: {str(e)}")
+
+def fair_queue(user_id, job_id):
+    """The queue for a user's interactive job: the default queue within their fair share, else overflow.
+
+    A job sent to the default queue holds a slot; release it with release_user_slot when the job ends.
+    """
+    if claim_user_slot(user_id, job_id):
+        return DEFAULT_QUEUE
+    logger.info(f"User {user_id} already has {USER_MAX_IN_FLIGHT} jobs in flight, job {job_id} yields to others")
+    return OVERFLOW_QUEUE
+
+def enqueue_meditation_job(job_id, user_id, situation, queue_name=DEFAULT_QUEUE, meta=None):
+    """Queue a meditation. Interactive jobs beyond the user's fair share wait on the overflow queue instead."""
+    if queue_name == DEFAULT_QUEUE:
+        queue_name = fair_queue(user_id, job_id)
+    try:
+        job = get_queue(queue_name).enqueue(
+            generate_meditation_job,
+            job_id, user_id, situation,
+            job_id=job_id,
+            job_timeout=JOB_TIMEOUT,
+            result_ttl=JOB_RESULT_TTL,
+            failure_ttl=JOB_RESULT_TTL,
+            meta={"stage": "queued", "user_id": user_id, "situation": situation, **(meta or {})},
+            on_failure=Callback(on_meditation_job_failure),
+            retry=Retry(max=JOB_MAX_RETRIES, interval=JOB_RETRY_INTERVALS or 0) if JOB_MAX_RETRIES > 0 else None
+        )
+    except Exception:
+        release_user_slot(user_id, job_id)
+        raise
+    logger.info(f"Enqueued job {job_id} for user {user_id} on queue {queue_name}")
+    return job
+
+def enqueue_renditions_job(job_id, user_id, audio_path):
+    """Queue the smaller encodings of a finished meditation behind any interactive work."""
+    job = get_queue(BATCH_QUEUE).enqueue(
+        generate_renditions_job,
+        job_id, user_id, audio_path,
+        job_id=f"renditions-{job_id}",
+        job_timeout=JOB_TIMEOUT,
+        result_ttl=JOB_RESULT_TTL,
+        failure_ttl=JOB_RESULT_TTL
+    )
+    logger.info(f"Enqueued renditions for job {job_id}")
+    return job
+
+def set_job_stage(stage, **fields):
+    """Record the current pipeline stage on the running RQ job, if there is one."""
+    job = get_current_job()
+    if job is None:
+        return
+    job.meta["stage"] = stage
+    job.meta.update(fields)
+    job.save_meta()
+    logger.info(f"Job {job.id} entered stage {stage}")
+
+def record_usage(**amounts):
+    """Add provider usage (tokens, characters) to the running job's meta["usage"] totals."""
+    job = get_current_job()
+    if job is None or not amounts:
+        return
+    usage = job.meta.setdefault("usage", {})
+    for name, amount in amounts.items():
+        usage[name] = usage.get(name, 0) + amount
+    job.save_meta()
+
+def get_job_status(job_id):
+    """Return the status dict for a job, or None if Redis no longer knows about it."""
+    try:
+        job = Job.fetch(job_id, connection=get_redis())
+    except NoSuchJobError:
+        return None
+    stage = job.meta.get("stage", "queued")
+    status = job.get_status()
+    if status in (JobStatus.FAILED, JobStatus.STOPPED, JobStatus.CANCELED) and stage != "failed":
+        # Killed by the worker (timeout, crash) before it could record the failure itself
+        stage = "failed"
+    return {
+        "job_id": job.id,
+        "stage": stage,
+        "user_id": job.meta.get("user_id"),
+        "script": job.meta.get("script"),
+        "error": job.meta.get("error") or (f"Job {status}" if stage == "failed" else None),
+    }
+
+def generate_meditation_job(job_id, user_id, situation):
+    """Run the pipeline for one meditation, picking up from whatever an earlier attempt finished."""
+    # Imported here so the web process can enqueue without loading the pipeline (and pydub)
+    from pipeline import (generate_meditation_script, generate_audio, saved_audio_path, ScriptStream,
+                          PIPELINED_GENERATION, AUDIO_RENDITIONS)
+    from checkpoints import JobCheckpoint
+    from metrics import observe, span
+
+    job = get_current_job()
+    if job is not None and job.enqueued_at:
+        observe("queue_wait", (datetime.now(timezone.utc) - job.enqueued_at.replace(tzinfo=timezone.utc)).total_seconds())
+    checkpoint = JobCheckpoint(job_id)
+    try:
+        with span("job"):
+            audio_path = saved_audio_path(job_id)
+            if audio_path:
+                # The last attempt stopped between saving the meditation and finishing the job
+                logger.info(f"Job {job_id} already saved {audio_path}, finishing")
+                if AUDIO_RENDITIONS:
+                    enqueue_renditions_job(job_id, user_id, audio_path)
+            else:
+                script = checkpoint.load_script()
+                if script:
+                    logger.info(f"Resuming job {job_id} from its checkpointed script")
+                    set_job_stage("synthesizing", script=script)
+                elif PIPELINED_GENERATION:
+                    set_job_stage("scripting")
+                    # Script writing and narration overlap; the stage moves on when the first segment is out.
+                    # The script is checkpointed as soon as it is written, so a retry never asks GPT-4o again
+                    script = ScriptStream(situation, on_complete=checkpoint.save_script)
+                else:
+                    set_job_stage("scripting")
+                    script = generate_meditation_script(situation)
+                    checkpoint.save_script(script)
+                    set_job_stage("synthesizing", script=script)
+                audio_path = generate_audio(script, job_id, user_id, situation, checkpoint=checkpoint)
+            commit_reservation(job_id)
+        checkpoint.clear()
+        set_job_stage("done")
+        release_user_slot(user_id, job_id)
+        return audio_path
+    except Exception as e:
+        logger.error(f"Meditation job {job_id} failed: {str(e)}")
+        if job is not None and job.retries_left:
+            # Not "failed" yet: the status page keeps waiting and the credit stays reserved
+            set_job_stage("retrying", last_error=str(e))
+        else:
+            set_job_stage("failed", error=str(e))
+        raise
+
+def generate_renditions_job(job_id, user_id, audio_path):
+    from pipeline import render_renditions
+    from storage import storage_for
+
+    return render_renditions(storage_for(audio_path).read(audio_path), job_id, user_id)
+
+def on_meditation_job_failure(job, connection, type, value, traceback):
+    """RQ failure callback: refund the credit once the job has failed for good.
+
+    Also runs for jobs that time out or whose worker died, where the job's own
+    exception handler never got the chance to.
+    """
+    if job.retries_left:
+        return
+    from checkpoints import JobCheckpoint
+    JobCheckpoint(job.id).clear()
+    job.meta["stage"] = "failed"
+    job.meta.setdefault("error", str(value) or type.__name__)
+    job.save_meta()
+    release_user_slot(job.meta.get("user_id"), job.id)
+    refund_reservation(job.id)
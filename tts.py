@@ -0,0 +1,158 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from elevenlabs import VoiceSettings
+from tasks import get_redis
+from ratelimit import acquire_elevenlabs_chars
+from metrics import span
+from tts_cache import get_segment_cache, segment_cache_key
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+TTS_VOICE = "Rachel"
+TTS_MODEL = "eleven_monolingual_v1"
+TTS_VOICE_SETTINGS = {"stability": 0.5, "similarity_boost": 0.5}
+
+# Concurrency caps: per process (thread pool size) and across every worker (Redis slots, 0 = unlimited)
+TTS_MAX_CONCURRENCY = int(os.getenv("TTS_MAX_CONCURRENCY", 4))
+TTS_GLOBAL_CONCURRENCY = int(os.getenv("TTS_GLOBAL_CONCURRENCY", 0))
+TTS_SLOT_TIMEOUT = int(os.getenv("TTS_SLOT_TIMEOUT", 120))  # seconds before a crashed holder's slot is reclaimed
+
+# Per-segment retry policy
+TTS_MAX_RETRIES = int(os.getenv("TTS_MAX_RETRIES", 3))
+TTS_RETRY_BACKOFF = float(os.getenv("TTS_RETRY_BACKOFF", 1.0))  # seconds, doubled on each attempt
+
+TTS_SLOTS_KEY = "tts:slots"
+
+_executor = None
+_executor_lock = threading.Lock()
+_usage_lock = threading.Lock()
+
+def get_executor():
+    """Return the process-wide TTS thread pool, which also enforces the per-process cap."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=TTS_MAX_CONCURRENCY, thread_name_prefix="tts")
+        return _executor
+
+@contextmanager
+def global_tts_slot():
+    """Hold one of TTS_GLOBAL_CONCURRENCY slots shared through Redis by all workers."""
+    if TTS_GLOBAL_CONCURRENCY <= 0:
+        yield
+        return
+    redis_conn = get_redis()
+    token = str(uuid.uuid4())
+    while True:
+        now = time.time()
+        pipe = redis_conn.pipeline()
+        pipe.zremrangebyscore(TTS_SLOTS_KEY, 0, now - TTS_SLOT_TIMEOUT)
+        pipe.zadd(TTS_SLOTS_KEY, {token: now})
+        pipe.zrank(TTS_SLOTS_KEY, token)
+        rank = pipe.execute()[2]
+        if rank is not None and rank < TTS_GLOBAL_CONCURRENCY:
+            break
+        redis_conn.zrem(TTS_SLOTS_KEY, token)
+        time.sleep(0.2 + random.random() * 0.3)
+    try:
+        yield
+    finally:
+        redis_conn.zrem(TTS_SLOTS_KEY, token)
+
+def _count(usage, name, amount):
+    if usage is not None:
+        with _usage_lock:
+            usage[name] += amount
+
+def synthesize_segment(client, text, usage=None):
+    """Synthesize one segment to MP3 bytes, retrying with exponential backoff.
+
+    Identical (text, voice, model, settings) requests are served from the segment cache.
+    Characters sent to (or saved from) ElevenLabs are added to the `usage` Counter.
+    """
+    cache = get_segment_cache()
+    cache_key = segment_cache_key(text, TTS_VOICE, TTS_MODEL, TTS_VOICE_SETTINGS)
+    if cache is not None:
+        audio = cache.get(cache_key)
+        if audio is not None:
+            logger.info(f"TTS cache hit for segment {cache_key[:12]}")
+            _count(usage, "tts_cached_characters", len(text))
+            return audio
+
+    acquire_elevenlabs_chars(len(text))
+    _count(usage, "tts_characters", len(text))
+    with span("tts_segment"):
+        return _synthesize_with_retries(client, text, cache, cache_key)
+
+def _synthesize_with_retries(client, text, cache, cache_key):
+    for attempt in range(TTS_MAX_RETRIES + 1):
+        try:
+            with global_tts_slot(), span("tts_request"):
+                audio_stream = client.generate(
+                    text=text,
+                    voice=TTS_VOICE,
+                    model=TTS_MODEL,
+                    voice_settings=VoiceSettings(**TTS_VOICE_SETTINGS)
+                )
+                audio = b"".join(chunk for chunk in audio_stream if chunk)
+            if not audio:
+                raise Exception("ElevenLabs returned no audio")
+            if cache is not None:
+                try:
+                    cache.put(cache_key, audio)
+                except Exception as e:
+                    logger.warning(f"Failed to cache TTS segment {cache_key[:12]}: {str(e)}")
+            return audio
+        except Exception as e:
+            if attempt == TTS_MAX_RETRIES:
+                raise
+            delay = TTS_RETRY_BACKOFF * (2 ** attempt) * (1 + random.random())
+            logger.warning(f"TTS attempt {attempt + 1} failed: {str(e)}, retrying in {delay:.1f} seconds")
+            time.sleep(delay)
+
+def _synthesize_and_report(client, text, index, on_segment, usage, checkpoint):
+    audio = checkpoint.get(text) if checkpoint is not None else None
+    if audio is not None:
+        logger.info(f"Segment {index} restored from checkpoint")
+    else:
+        audio = synthesize_segment(client, text, usage)
+        if checkpoint is not None:
+            checkpoint.put(text, audio)
+    if on_segment is not None:
+        on_segment(index, audio)
+    return audio
+
+def synthesize_segments(client, segments, job_id, on_segment=None, usage=None, checkpoint=None):
+    """Synthesize segments concurrently and return their MP3 bytes in script order.
+
+    `segments` may be any iterable; each one is submitted as soon as it is produced.
+    `on_segment(index, audio)` is called from the pool as each segment finishes.
+    `usage`, if given, is a Counter that collects character counts.
+    With a `checkpoint` (see checkpoints.JobCheckpoint), segments it holds are
+    reused and new ones are saved to it. A failed segment does not stop the
+    others, so a retry of the job only has to synthesize the ones that failed.
+    """
+    executor = get_executor()
+    futures = []
+    for i, segment in enumerate(segments):
+        logger.info(f"Queueing TTS for job {job_id} segment {i}: {segment[:50]}...")
+        futures.append(executor.submit(_synthesize_and_report, client, segment, i, on_segment, usage, checkpoint))
+    results = []
+    failed = []
+    for i, future in enumerate(futures):
+        try:
+            results.append(future.result())
+            logger.info(f"Segment {i} synthesized for job {job_id}")
+        except Exception as e:
+            logger.error(f"Segment {i} failed for job {job_id}: {str(e)}")
+            failed.append((i, e))
+    if failed:
+        indexes = ", ".join(str(i) for i, _ in failed)
+        raise Exception(f"Failed to synthesize segment(s) {indexes} for job {job_id}: {str(failed[0][1])}")
+    return results
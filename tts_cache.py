@@ -0,0 +1,201 @@
+from tasks import get_redis
+import hashlib
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+TTS_CACHE_ENABLED = os.getenv("TTS_CACHE_ENABLED", "1") == "1"
+TTS_CACHE_DIR = os.getenv("TTS_CACHE_DIR", "cache/tts")
+TTS_CACHE_MAX_BYTES = int(os.getenv("TTS_CACHE_MAX_MB", 512)) * 1024 * 1024
+# Keep a Redis index of what this disk holds so eviction never has to scan the directory
+TTS_CACHE_REDIS_INDEX = os.getenv("TTS_CACHE_REDIS_INDEX", "0") == "1"
+# Each dyno has its own disk, so the index is namespaced per host
+TTS_CACHE_NAMESPACE = os.getenv("TTS_CACHE_NAMESPACE", socket.gethostname())
+
+TTS_CACHE_STATS_KEY = "tts:cache:stats"
+
+def segment_cache_key(text, voice, model, voice_settings):
+    """Content address for one synthesized segment."""
+    payload = json.dumps({
+        "text": " ".join(text.split()),
+        "voice": voice,
+        "model": model,
+        "voice_settings": voice_settings,
+    }, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+class SegmentCache:
+    """Size-bounded LRU of MP3 segments on local disk.
+
+    Recency is the file mtime, refreshed on every hit. With a Redis index the
+    same recency is mirrored in a sorted set, and sizes in a hash with a running
+    total, so eviction can pick victims without walking the cache directory. The
+    index is seeded from disk the first time a process uses it.
+    """
+
+    def __init__(self, root, max_bytes, use_redis_index=False, namespace=""):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.use_redis_index = use_redis_index
+        self.index_key = f"tts:cache:index:{namespace}"
+        self.sizes_key = f"tts:cache:sizes:{namespace}"
+        self.total_key = f"tts:cache:total:{namespace}"
+        self.hits = 0
+        self.misses = 0
+        self._total_bytes = None
+        self._index_seeded = False
+        self._lock = threading.Lock()
+
+    def _path(self, key):
+        return os.path.join(self.root, key[:2], f"{key}.mp3")
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            self._record("misses")
+            return None
+        self._record("hits")
+        if self.use_redis_index:
+            self._redis_call(lambda r: r.zadd(self.index_key, {key: time.time()}))
+        return data
+
+    def put(self, key, data):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if self.use_redis_index:
+            self._seed_index()
+        try:
+            # Rewriting a key replaces its file, so only the difference counts towards the total
+            old_size = os.path.getsize(path)
+        except FileNotFoundError:
+            old_size = 0
+        # Write under a unique name and rename, so readers never see a partial file
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        if self.use_redis_index:
+            def index(r):
+                pipe = r.pipeline()
+                pipe.zadd(self.index_key, {key: time.time()})
+                pipe.hset(self.sizes_key, key, len(data))
+                pipe.incrby(self.total_key, len(data) - old_size)
+                pipe.execute()
+            self._redis_call(index)
+        with self._lock:
+            if self._total_bytes is not None:
+                self._total_bytes += len(data) - old_size
+        self._evict()
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+    def _record(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+        self._redis_call(lambda r: r.hincrby(TTS_CACHE_STATS_KEY, counter, 1))
+
+    def _redis_call(self, fn):
+        # The cache must keep working when Redis is unavailable
+        try:
+            return fn(get_redis())
+        except Exception as e:
+            logger.warning(f"TTS cache Redis call failed: {str(e)}")
+            return None
+
+    def _seed_index(self):
+        """Index the segments already on disk, unless another process has done it."""
+        with self._lock:
+            if self._index_seeded:
+                return
+            indexed = self._redis_call(lambda r: r.exists(self.total_key))
+            if indexed is None:
+                return
+            if not indexed:
+                entries = self._entries_by_age()
+
+                def seed(r):
+                    pipe = r.pipeline()
+                    for mtime, size, key in entries:
+                        pipe.zadd(self.index_key, {key: mtime})
+                        pipe.hset(self.sizes_key, key, size)
+                    pipe.set(self.total_key, sum(size for _, size, _ in entries))
+                    return pipe.execute()
+                if self._redis_call(seed) is None:
+                    return
+                logger.info(f"Seeded TTS cache index with {len(entries)} segments from disk")
+            self._index_seeded = True
+
+    def _entries_by_age(self):
+        """(mtime, size, key) for every cached segment, oldest first."""
+        entries = []
+        for shard in os.scandir(self.root):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.name.endswith(".mp3"):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.name[:-4]))
+        entries.sort()
+        return entries
+
+    def _evict(self):
+        with self._lock:
+            if self.use_redis_index:
+                total = int(self._redis_call(lambda r: r.get(self.total_key)) or 0)
+                if total <= self.max_bytes:
+                    return
+                victims = self._redis_call(lambda r: r.zrange(self.index_key, 0, 63)) or []
+                for raw_key in victims:
+                    if total <= self.max_bytes:
+                        break
+                    key = raw_key.decode() if isinstance(raw_key, bytes) else raw_key
+                    size = self._redis_call(lambda r: r.hget(self.sizes_key, key))
+                    self._remove(key)
+                    removed = self._redis_call(lambda r: r.pipeline().zrem(self.index_key, key).hdel(self.sizes_key, key).execute())
+                    # Only the process that dropped the entry from the index takes its size off the total
+                    if removed and removed[1]:
+                        self._redis_call(lambda r: r.decrby(self.total_key, int(size or 0)))
+                    total -= int(size or 0)
+                return
+
+            if self._total_bytes is None:
+                self._total_bytes = sum(size for _, size, _ in self._entries_by_age())
+            if self._total_bytes <= self.max_bytes:
+                return
+            for _, size, key in self._entries_by_age():
+                if self._total_bytes <= self.max_bytes:
+                    break
+                self._remove(key)
+                self._total_bytes -= size
+
+    def _remove(self, key):
+        try:
+            os.remove(self._path(key))
+            logger.info(f"Evicted TTS cache entry {key}")
+        except FileNotFoundError:
+            pass
+
+_segment_cache = None
+
+def get_segment_cache():
+    """Return the process-wide segment cache, or None when caching is disabled."""
+    global _segment_cache
+    if not TTS_CACHE_ENABLED:
+        return None
+    if _segment_cache is None:
+        _segment_cache = SegmentCache(
+            TTS_CACHE_DIR, TTS_CACHE_MAX_BYTES,
+            use_redis_index=TTS_CACHE_REDIS_INDEX, namespace=TTS_CACHE_NAMESPACE
+        )
+    return _segment_cache
@@ -1,16 +1,48 @@
+from dotenv import load_dotenv
+
+load_dotenv()
+
 from rq import Worker, Queue
 from redis_config import get_redis_connection
+from tasks import DEFAULT_QUEUE, OVERFLOW_QUEUE, BATCH_QUEUE
+from audio import get_assets
+from db import init_db
+from maintenance import schedule_maintenance
+from storage import STORAGE_BACKEND, LOCAL_STORAGE_SHARED
 import logging
+import os
+import pipeline  # noqa: F401 - loaded once here so every forked job starts with it imported
 
 logging.basicConfig(level=logging.INFO)
 
+def check_storage():
+    """Workers save the audio the web app serves, so they must write somewhere the web app can read."""
+    if STORAGE_BACKEND != "local" or LOCAL_STORAGE_SHARED:
+        return
+    if os.getenv("DYNO"):
+        # Heroku gives every dyno its own disk: meditations saved here would 404 on the web dyno
+        raise RuntimeError("The worker dyno cannot share static/audio with the web dyno; "
+                           "set STORAGE_BACKEND=s3 (or LOCAL_STORAGE_SHARED=1 if the disk really is shared)")
+    logging.warning("STORAGE_BACKEND=local: audio is saved to this machine's static/audio. The web app can only "
+                    "serve it if it runs on the same machine or volume; set LOCAL_STORAGE_SHARED=1 once it does, "
+                    "or use STORAGE_BACKEND=s3")
+
 if __name__ == "__main__":
     try:
+        check_storage()
+        init_db()
         redis_conn = get_redis_connection()
-        q = Queue(connection=redis_conn)
-        worker = Worker([q])
+        # Listed in priority order: a user's jobs beyond their fair share wait for everyone else's,
+        # and batch jobs only run when no interactive job is waiting
+        queues = [Queue(name, connection=redis_conn) for name in (DEFAULT_QUEUE, OVERFLOW_QUEUE, BATCH_QUEUE)]
+        worker = Worker(queues)
+        # Load chimes and ambience before forking so every job shares them
+        get_assets().preload()
+        # Storage housekeeping reschedules itself after every pass; this starts the chain
+        schedule_maintenance()
         logging.info("Starting RQ worker...")
-        worker.work()
+        # The scheduler enqueues job retries once their backoff interval has passed
+        worker.work(with_scheduler=True)
     except Exception as e:
         logging.error(f"Worker failed: {str(e)}")
         raise
\ No newline at end of file